@@ -0,0 +1,80 @@
+import json
+from functools import lru_cache
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibCodec:
+    """Compact JSON with the standard library"""
+    name = 'json'
+
+    def __init__(self):
+        self._plain_encoder = self._new_encoder()
+
+    @staticmethod
+    def _new_encoder(default=None):
+        return json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=default)
+
+    def _encoder(self, default):
+        # Only the encoder without `default` is kept, callers may pass a new callable each time
+        return self._plain_encoder if default is None else self._new_encoder(default)
+
+    def dumps(self, value, default=None):
+        return self._encoder(default).encode(value)
+
+    def dumps_bytes(self, value, default=None):
+        return self.dumps(value, default).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """JSON with orjson, several times faster than the standard library on documents"""
+    name = 'orjson'
+
+    def dumps(self, value, default=None):
+        return self.dumps_bytes(value, default).decode('utf-8')
+
+    def dumps_bytes(self, value, default=None):
+        return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+@lru_cache(maxsize=None)
+def get_codec(name=None):
+    """
+    Return the JSON codec named by settings.JSON_CODEC: 'orjson', 'json', or
+    'auto' (the default) for orjson when it is installed and json otherwise.
+    """
+    name = name or getattr(settings, 'JSON_CODEC', 'auto')
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError("JSON_CODEC is 'orjson' but the orjson package is not installed")
+        return OrjsonCodec()
+    if name == 'json':
+        return StdlibCodec()
+    raise ValueError(f"Unknown JSON codec: {name!r}")
+
+
+def dumps(value, default=None):
+    """Encode a value to a JSON string; `default` converts the values JSON doesn't support"""
+    return get_codec().dumps(value, default)
+
+
+def dumps_bytes(value, default=None):
+    """Encode a value to UTF-8 JSON bytes"""
+    return get_codec().dumps_bytes(value, default)
+
+
+def loads(data):
+    """Decode JSON from a string or UTF-8 bytes"""
+    return get_codec().loads(data)
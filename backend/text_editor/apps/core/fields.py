@@ -0,0 +1,101 @@
+import zlib
+from django import forms
+from django.conf import settings
+from django.db import models
+from . import codec as json_codec
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSION_DEFAULTS = {
+    'CODEC': 'zlib',
+    'LEVEL': 1,
+    'MIN_SIZE': 512,
+}
+
+# First byte of a stored value, naming how the JSON after it is encoded
+RAW = b'\x00'
+ZLIB = b'\x01'
+ZSTD = b'\x02'
+
+
+def compression_setting(name):
+    """Read an option of settings.CONTENT_COMPRESSION, falling back to the defaults"""
+    options = getattr(settings, 'CONTENT_COMPRESSION', {})
+    return options.get(name, COMPRESSION_DEFAULTS[name])
+
+
+def compress_json(value, codec=None):
+    """
+    Serialize a JSON value compactly and compress it with the configured codec.
+
+    Values smaller than MIN_SIZE are kept raw, they don't shrink enough to be
+    worth the decompression. 'zstd' needs the zstandard package and falls
+    back to zlib without it; 'none' stores every value raw.
+    """
+    data = json_codec.dumps_bytes(value)
+    codec = codec or compression_setting('CODEC')
+    if codec == 'none' or len(data) < compression_setting('MIN_SIZE'):
+        return RAW + data
+    if codec == 'zstd' and zstandard is not None:
+        return ZSTD + zstandard.ZstdCompressor(level=compression_setting('LEVEL')).compress(data)
+    return ZLIB + zlib.compress(data, compression_setting('LEVEL'))
+
+
+def decompress_json(data):
+    """Decode a value stored by compress_json, whatever codec it was written with"""
+    data = bytes(data)
+    header, data = data[:1], data[1:]
+    if header == ZLIB:
+        data = zlib.decompress(data)
+    elif header == ZSTD:
+        if zstandard is None:
+            raise ValueError("Value is compressed with zstd but the zstandard package is not installed")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif header != RAW:
+        raise ValueError(f"Unknown compressed JSON header: {header!r}")
+    return json_codec.loads(data)
+
+
+class CompressedJSONField(models.BinaryField):
+    """
+    JSON value stored as compressed bytes and decoded when read.
+
+    Behaves like a JSONField for the code using the model, but the value can't
+    be queried inside the database.
+    """
+    description = "Compressed JSON"
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('editable', True)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if kwargs.get('editable'):
+            del kwargs['editable']
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decompress_json(value)
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            return decompress_json(value)
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        return compress_json(value)
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+    def formfield(self, **kwargs):
+        return super().formfield(**{'form_class': forms.JSONField, **kwargs})
@@ -0,0 +1,77 @@
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from text_editor.apps.document.diff import block_hashes, diff_blocks
+from text_editor.apps.document.utils import get_position_of_change
+
+
+def edit_one_block(blocks):
+    blocks[len(blocks) // 2]['content'] += ' typed'
+
+
+def insert_block(blocks):
+    blocks.insert(len(blocks) // 3, {'type': 'image', 'content': 'https://example.com/image.png'})
+
+
+def delete_block(blocks):
+    del blocks[len(blocks) // 4]
+
+
+def move_block(blocks):
+    blocks.insert(len(blocks) - 10, blocks.pop(10))
+
+
+def rewrite_ten_percent(blocks):
+    for index in random.sample(range(len(blocks)), len(blocks) // 10):
+        blocks[index]['content'] = f'rewritten {index}'
+
+
+CHANGES = {
+    'edit one block': edit_one_block,
+    'insert a block': insert_block,
+    'delete a block': delete_block,
+    'move a block': move_block,
+    'rewrite 10%': rewrite_ten_percent,
+}
+
+
+class Command(BaseCommand):
+    help = 'Measures get_position_of_change against the block diff on large documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 10000],
+                            help='Number of blocks of the documents')
+        parser.add_argument('--iterations', type=int, default=20, help='Runs per measurement')
+
+    def handle(self, *args, **options):
+        for size in options['sizes']:
+            old_blocks = [
+                {'type': 'text', 'content': f'paragraph {i} ' * 8, 'metadata': {'position': i, 'style': {}}}
+                for i in range(size)
+            ]
+            old_content = {'blocks': old_blocks, 'type': 'text', 'content': ''}
+            old_hashes = block_hashes(old_blocks)
+
+            self.stdout.write(f'{size} blocks')
+            for name, change in CHANGES.items():
+                new_blocks = [dict(block) for block in old_blocks]
+                change(new_blocks)
+                new_content = {'blocks': new_blocks, 'type': 'text', 'content': ''}
+
+                scan = self.measure(lambda: get_position_of_change(old_content, new_content), options)
+                diff = self.measure(lambda: diff_blocks(old_blocks, new_blocks), options)
+                hashed = self.measure(lambda: diff_blocks(old_blocks, new_blocks, old_hashes), options)
+                ops, _ = diff_blocks(old_blocks, new_blocks, old_hashes)
+                self.stdout.write(
+                    f'  {name:>15}: position scan {scan:.2f} ms, '
+                    f'diff {diff:.2f} ms, diff updating cached hashes {hashed:.2f} ms ({len(ops)} ops)'
+                )
+
+    def measure(self, function, options):
+        timings = []
+        for _ in range(options['iterations']):
+            start = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
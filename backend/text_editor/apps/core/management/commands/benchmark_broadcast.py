@@ -0,0 +1,125 @@
+import asyncio
+import json
+import time
+import uuid
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.core.management.base import BaseCommand
+from text_editor.apps.core import codec
+from text_editor.apps.document.consumer import DocumentConsumer
+
+
+async def encode_per_consumer(consumer, event):
+    """The previous room handler: every consumer encodes the document itself"""
+    await consumer.send(text_data=json.dumps({
+        'type': 'UPDATE',
+        'document': event['document'],
+    }))
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures the CPU time of fanning an edit out to a room, encoding per consumer vs once per group send, '
+        'with the time spent encoding reported apart from the time spent in the channel layer'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50, help='Sockets in the room')
+        parser.add_argument('--edits', type=int, default=200, help='Edits broadcast per measurement')
+        parser.add_argument('--blocks', type=int, default=200, help='Blocks in the document')
+        parser.add_argument(
+            '--layer', choices=['memory', 'settings'], default='memory',
+            help="'memory' for an InMemoryChannelLayer, which deep copies every message it delivers; "
+                 "'settings' for the layer of CHANNEL_LAYERS, e.g. channels-redis with CHANNEL_LAYER_BACKEND=redis",
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        document = {
+            'id': '1',
+            'version': 1,
+            'content': {
+                'blocks': [
+                    {'type': 'text', 'content': f'block {i} ' * 10, 'metadata': {'position': i, 'style': {}}}
+                    for i in range(options['blocks'])
+                ],
+                'type': 'text',
+                'content': '',
+            },
+        }
+
+        def per_consumer(sender):
+            return {'type': 'document_update', 'document': document}, encode_per_consumer
+
+        def once(sender):
+            event = {
+                'type': 'document_broadcast',
+                'text': codec.dumps({'type': 'UPDATE', 'document': document}),
+                'sender': sender.channel_name,
+            }
+            return event, DocumentConsumer.document_broadcast
+
+        layer = self.channel_layer(options)
+        self.stdout.write(
+            f"{options['clients']} clients, {options['edits']} edits, "
+            f"{len(json.dumps(document))} byte document, {type(layer).__name__}"
+        )
+        for name, build_event in (('encode per consumer', per_consumer), ('encode once', once)):
+            encoding, delivery, frames = await self.measure(layer, build_event, options)
+            self.stdout.write(
+                f'{name:>20}: {encoding * 1000 / options["edits"]:.3f} ms CPU encoding, '
+                f'{delivery * 1000 / options["edits"]:.3f} ms CPU in the channel layer per edit, '
+                f'{frames} frames sent'
+            )
+
+    def channel_layer(self, options):
+        if options['layer'] == 'settings':
+            return get_channel_layer()
+        return InMemoryChannelLayer(capacity=options['edits'] + 1)
+
+    async def measure(self, layer, build_event, options):
+        """
+        Broadcast edits through a channel layer to a room of consumers and time
+        the CPU spent building and handling the events apart from the CPU spent
+        sending and receiving them. The layer's own copies and serialization
+        count as channel layer time.
+        """
+        group = f'benchmark_{uuid.uuid4().hex}'
+        frames = 0
+
+        async def count_frame(message):
+            nonlocal frames
+            frames += 1
+
+        consumers = []
+        for _ in range(options['clients']):
+            consumer = DocumentConsumer()
+            consumer.channel_layer = layer
+            consumer.channel_name = await layer.new_channel()
+            consumer.base_send = count_frame
+            await layer.group_add(group, consumer.channel_name)
+            consumers.append(consumer)
+
+        encoding = delivery = 0
+        for _ in range(options['edits']):
+            start = time.process_time()
+            event, handler = build_event(consumers[0])
+            encoding += time.process_time() - start
+
+            start = time.process_time()
+            await layer.group_send(group, event)
+            delivery += time.process_time() - start
+
+            for consumer in consumers:
+                start = time.process_time()
+                message = await layer.receive(consumer.channel_name)
+                delivery += time.process_time() - start
+
+                start = time.process_time()
+                await handler(consumer, message)
+                encoding += time.process_time() - start
+
+        for consumer in consumers:
+            await layer.group_discard(group, consumer.channel_name)
+        return encoding, delivery, frames
@@ -0,0 +1,100 @@
+import random
+import statistics
+import time
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from text_editor.apps.core.fields import compress_json, decompress_json, zstandard
+from text_editor.apps.core.models import Document, OperationalLog
+
+User = get_user_model()
+
+
+WORDS = (
+    'the document editor block text image style author version change room shared link reader writer '
+    'paragraph section figure table note draft review comment update delta snapshot server client'
+).split()
+
+
+def large_content(block_count):
+    """Content with text and image blocks carrying styling, like documents edited in the app"""
+    words = random.Random(block_count)
+    blocks = []
+    for i in range(block_count):
+        if i % 5 == 0:
+            blocks.append({
+                'type': 'image',
+                'content': f'https://images.example.com/documents/uploads/2025/04/figure-{i}.png',
+                'metadata': {'position': i, 'style': {'width': '100%', 'height': 'auto', 'align': 'center'}},
+            })
+        else:
+            blocks.append({
+                'type': 'text',
+                'content': ' '.join(words.choice(WORDS) for _ in range(40)),
+                'metadata': {'position': i, 'style': {'fontSize': '16px', 'fontFamily': 'Inter', 'color': '#1f2937'}},
+            })
+    return {'blocks': blocks, 'type': 'text', 'content': ''}
+
+
+class Command(BaseCommand):
+    help = 'Compares the stored size and read latency of document content per compression codec (data is rolled back)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000],
+                            help='Number of blocks of the documents')
+        parser.add_argument('--iterations', type=int, default=50, help='Runs per measurement')
+
+    def handle(self, *args, **options):
+        codecs = ['none', 'zlib'] + (['zstd'] if zstandard is not None else [])
+
+        with transaction.atomic():
+            user = User.objects.create_user(email='benchmark@example.com', password=None)
+            for size in options['sizes']:
+                content = large_content(size)
+                self.stdout.write(f'{size} blocks')
+
+                # Baseline: the same value in a plain JSON column
+                document = Document.objects.create(title='benchmark', user=user)
+                log = OperationalLog.objects.create(document=document, operation='delta', operation_data=content)
+                read = self.measure(
+                    lambda: OperationalLog.objects.filter(id=log.id).values_list('operation_data', flat=True).get(),
+                    options,
+                )
+                stored = self.column_size(OperationalLog, 'operation_data', log.id)
+                self.stdout.write(f'  {"json column":>12}: stored {stored / 1024:8.1f} KiB, read {read:.2f} ms')
+
+                for codec in codecs:
+                    with override_settings(CONTENT_COMPRESSION={'CODEC': codec}):
+                        Document.objects.filter(id=document.id).update(content=content)
+                        encode = self.measure(lambda: compress_json(content), options)
+                    encoded = compress_json(content, codec)
+                    decode = self.measure(lambda: decompress_json(encoded), options)
+                    read = self.measure(
+                        lambda: Document.objects.filter(id=document.id).values_list('content', flat=True).get(),
+                        options,
+                    )
+                    stored = self.column_size(Document, 'content', document.id)
+                    self.stdout.write(
+                        f'  {codec:>12}: stored {stored / 1024:8.1f} KiB, read {read:.2f} ms '
+                        f'(encode {encode:.2f} ms, decode {decode:.2f} ms)'
+                    )
+
+            transaction.set_rollback(True)
+
+    def column_size(self, model, field_name, row_id):
+        """Bytes the database uses for a value, after its own compression on PostgreSQL"""
+        column = connection.ops.quote_name(model._meta.get_field(field_name).column)
+        table = connection.ops.quote_name(model._meta.db_table)
+        size = 'pg_column_size' if connection.vendor == 'postgresql' else 'length'
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {size}({column}) FROM {table} WHERE id = %s', [row_id])
+            return cursor.fetchone()[0]
+
+    def measure(self, function, options):
+        timings = []
+        for _ in range(options['iterations']):
+            start = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
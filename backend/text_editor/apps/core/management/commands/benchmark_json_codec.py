@@ -0,0 +1,51 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from text_editor.apps.core.codec import StdlibCodec, OrjsonCodec, orjson
+from text_editor.apps.core.renderers import CodecJSONRenderer
+from .benchmark_content_storage import large_content
+
+
+class Command(BaseCommand):
+    help = 'Compares encode and decode latency of the JSON codecs on documents, in socket messages and API responses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000],
+                            help='Number of blocks of the documents')
+        parser.add_argument('--iterations', type=int, default=50, help='Runs per measurement')
+
+    def handle(self, *args, **options):
+        codecs = [StdlibCodec()] + ([OrjsonCodec()] if orjson is not None else [])
+        if orjson is None:
+            self.stdout.write('orjson is not installed, only measuring the standard library')
+
+        for size in options['sizes']:
+            message = {
+                'type': 'UPDATE',
+                'document': {'id': '1', 'version': 1, 'content': large_content(size)},
+            }
+            self.stdout.write(f'{size} blocks')
+
+            for codec in codecs:
+                encoded = codec.dumps(message)
+                encode = self.measure(lambda: codec.dumps(message), options)
+                decode = self.measure(lambda: codec.loads(encoded), options)
+                self.stdout.write(
+                    f'  {codec.name:>8}: encode {encode:.2f} ms, decode {decode:.2f} ms, '
+                    f'{len(encoded.encode("utf-8")) / 1024:.1f} KiB'
+                )
+
+            # API responses, DRF's renderer vs the one used by the REST_FRAMEWORK settings
+            document = message['document']
+            for name, renderer in (('drf', JSONRenderer()), ('codec', CodecJSONRenderer())):
+                render = self.measure(lambda: renderer.render(document, 'application/json'), options)
+                self.stdout.write(f'  {name + " api":>8}: render {render:.2f} ms')
+
+    def measure(self, function, options):
+        timings = []
+        for _ in range(options['iterations']):
+            start = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
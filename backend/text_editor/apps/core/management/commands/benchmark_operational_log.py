@@ -0,0 +1,88 @@
+import random
+import statistics
+import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from text_editor.apps.core.models import Document, OperationalLog
+from text_editor.apps.document.blocks import snapshot_fields
+from text_editor.apps.document.utils import get_ops_since, reconstruct_version
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Measures OperationalLog version lookups on a document with a large log (data is rolled back)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100_000, help='Number of log rows to create')
+        parser.add_argument('--iterations', type=int, default=200, help='Lookups per measurement')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        interval = getattr(settings, 'OPERATIONAL_LOG_SNAPSHOT_INTERVAL', 50)
+
+        with transaction.atomic():
+            user = User.objects.create_user(email='benchmark@example.com', password=None)
+            document = Document.objects.create(title='benchmark', user=user, current_version=rows)
+            self.fill_log(document, rows, interval)
+
+            versions = [random.randint(2, rows) for _ in range(options['iterations'])]
+            lookups = {
+                'latest version': lambda v: (
+                    OperationalLog.objects.filter(document_id=document.id)
+                    .order_by('-version').values_list('version', flat=True).first()
+                ),
+                'single version': lambda v: (
+                    OperationalLog.objects.filter(document_id=document.id, version=v)
+                    .values('operation', 'operation_data').first()
+                ),
+                'nearest snapshot': lambda v: (
+                    OperationalLog.objects.filter(document_id=document.id, version__lte=v, is_snapshot=True)
+                    .order_by('-version').values_list('version', flat=True).first()
+                ),
+                'ops since v-20': lambda v: get_ops_since(document.id, max(v - 20, 1), v),
+                'reconstruct version': lambda v: reconstruct_version(document.id, v),
+            }
+
+            self.stdout.write(f'{rows} log rows, snapshot every {interval} versions')
+            for name, lookup in lookups.items():
+                timings = []
+                for version in versions:
+                    start = time.perf_counter()
+                    lookup(version)
+                    timings.append((time.perf_counter() - start) * 1000)
+                timings.sort()
+                self.stdout.write(
+                    f'{name:>20}: mean {statistics.mean(timings):.3f} ms, '
+                    f'p95 {timings[int(len(timings) * 0.95) - 1]:.3f} ms'
+                )
+
+            transaction.set_rollback(True)
+
+    def fill_log(self, document, rows, interval, block_count=200):
+        """Log `rows` versions of a document with block_count blocks, one block replaced per version"""
+        blocks = [{"type": "text", "content": f"block {i}"} for i in range(block_count)]
+        batch = []
+        for version in range(1, rows + 1):
+            index = version % block_count
+            block = {"type": "text", "content": f"block {index} v{version}"}
+            blocks[index] = block
+            is_snapshot = version % interval == 1
+            snapshot = {'updated_content': None}
+            if is_snapshot:
+                snapshot = snapshot_fields(document.id, {"blocks": blocks[:], "type": "text", "content": ""})
+            batch.append(OperationalLog(
+                document=document,
+                operation='delta',
+                version=version,
+                position=index,
+                is_snapshot=is_snapshot,
+                **snapshot,
+                operation_data={'ops': [{'op': 'replace', 'index': index, 'block': block}]},
+            ))
+            if len(batch) == 5000:
+                OperationalLog.objects.bulk_create(batch)
+                batch = []
+        OperationalLog.objects.bulk_create(batch)
@@ -0,0 +1,126 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.functions import Mod
+from text_editor.apps.core.models import Block, Document, OperationalLog
+from text_editor.apps.document.blocks import expand_snapshot, snapshot_fields
+from text_editor.apps.document.delta import apply_delta, DeltaError
+
+
+class Command(BaseCommand):
+    help = (
+        'Compacts the operation log: keeps the last N versions of each document, squashes older ones '
+        'into checkpoints and drops the blocks no snapshot uses anymore'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=50,
+                            help='Number of most recent versions kept per document')
+        parser.add_argument('--checkpoint-every', type=int, default=0,
+                            help='Keep a full snapshot of every Nth older version (0 drops them all)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of documents and log rows fetched per query')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Run again every N seconds instead of exiting')
+
+    def handle(self, *args, **options):
+        if options['keep'] < 1:
+            # Compacting would otherwise delete the latest version, the one the document is at
+            raise CommandError('--keep must be at least 1')
+
+        while True:
+            compacted, deleted = self.compact_all(options)
+            self.stdout.write(self.style.SUCCESS(
+                f'Compacted {compacted} documents, deleted {deleted} log entries'
+            ))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
+
+    def compact_all(self, options):
+        compacted = deleted = 0
+        document_ids = Document.objects.order_by('id').values_list('id', flat=True)
+        for document_id in document_ids.iterator(chunk_size=options['batch_size']):
+            count = self.compact_document(document_id, options)
+            if count:
+                compacted += 1
+                deleted += count
+        return compacted, deleted
+
+    def compact_document(self, document_id, options):
+        logs = OperationalLog.objects.filter(document_id=document_id)
+        latest = logs.aggregate(latest=Max('version'))['latest']
+        if latest is None:
+            return 0
+
+        cutoff = latest - options['keep'] + 1
+        if not logs.filter(version__lt=cutoff).exists():
+            return 0
+
+        checkpoint_every = options['checkpoint_every']
+
+        with transaction.atomic():
+            # Walk the old versions once, rebuilding the content as we go, so the
+            # rows we keep can be turned into snapshots without loading the whole log
+            content = None
+            rows = logs.filter(version__lte=cutoff).order_by('version').values_list(
+                'id', 'version', 'is_snapshot', 'updated_content', 'block_refs', 'operation_data'
+            )
+            for log_id, version, is_snapshot, updated_content, block_refs, operation_data in rows.iterator(
+                chunk_size=options['batch_size']
+            ):
+                if is_snapshot:
+                    content = expand_snapshot(document_id, updated_content, block_refs)
+                elif content is not None and operation_data and operation_data.get('ops'):
+                    try:
+                        content = apply_delta(content, operation_data['ops'])
+                    except DeltaError as e:
+                        content = None
+                        self.stderr.write(f'Document {document_id} v{version}: {e}')
+                else:
+                    content = None
+
+                keep = version == cutoff or (checkpoint_every and version % checkpoint_every == 0)
+                if keep and not is_snapshot:
+                    if content is None:
+                        # The chain is broken here, leave this document untouched
+                        self.stderr.write(f'Document {document_id}: cannot rebuild v{version}, skipping')
+                        transaction.set_rollback(True)
+                        return 0
+                    OperationalLog.objects.filter(id=log_id).update(
+                        is_snapshot=True,
+                        **snapshot_fields(document_id, content),
+                    )
+
+            old_logs = logs.filter(version__lt=cutoff)
+            if checkpoint_every:
+                old_logs = old_logs.annotate(
+                    checkpoint=Mod('version', checkpoint_every)
+                ).exclude(checkpoint=0)
+            deleted, _ = old_logs.delete()
+            self.delete_unused_blocks(document_id, options)
+
+        return deleted
+
+    def delete_unused_blocks(self, document_id, options):
+        """
+        Delete the stored blocks of a document that no remaining snapshot references.
+
+        Runs in the compaction's transaction. Flushes update the document row
+        before storing blocks, so locking it here keeps a flush from reusing a
+        block deleted as unused until this commits.
+        """
+        list(Document.objects.select_for_update().filter(id=document_id).values_list('id', flat=True))
+
+        used = set()
+        refs = OperationalLog.objects.filter(
+            document_id=document_id, block_refs__isnull=False
+        ).values_list('block_refs', flat=True)
+        for block_refs in refs.iterator(chunk_size=options['batch_size']):
+            used.update(block_refs)
+
+        blocks = Block.objects.filter(document_id=document_id)
+        unused = [ref for ref in blocks.values_list('hash', flat=True).iterator() if ref not in used]
+        for start in range(0, len(unused), options['batch_size']):
+            blocks.filter(hash__in=unused[start:start + options['batch_size']]).delete()
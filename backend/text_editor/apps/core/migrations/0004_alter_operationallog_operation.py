@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_alter_document_content'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='operationallog',
+            name='operation',
+            field=models.CharField(choices=[('insert', 'Insert'), ('delete', 'Delete'), ('undo', 'Undo'), ('redo', 'Redo'), ('image_insert', 'Image Insert'), ('image_delete', 'Image Delete'), ('delta', 'Delta')], max_length=255),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:24
+
+from django.db import migrations, models
+
+
+def mark_existing_logs_as_snapshots(apps, schema_editor):
+    # Every log written before this migration holds the full content
+    OperationalLog = apps.get_model('core', 'OperationalLog')
+    OperationalLog.objects.filter(updated_content__isnull=False).update(is_snapshot=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_alter_operationallog_operation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='operationallog',
+            name='is_snapshot',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='operationallog',
+            name='updated_content',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_existing_logs_as_snapshots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_versions(apps, schema_editor):
+    # Concurrent saves could log the same version twice, keep the last one written
+    OperationalLog = apps.get_model('core', 'OperationalLog')
+    duplicates = (
+        OperationalLog.objects.values('document_id', 'version')
+        .annotate(last_id=Max('id'), count=Count('id'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        OperationalLog.objects.filter(
+            document_id=duplicate['document_id'],
+            version=duplicate['version'],
+        ).exclude(id=duplicate['last_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_operationallog_snapshots'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_versions, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='operationallog',
+            index=models.Index(condition=models.Q(('is_snapshot', True)), fields=['document', 'version'], name='operationallog_snapshot_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='operationallog',
+            constraint=models.UniqueConstraint(fields=('document', 'version'), name='unique_document_version'),
+        ),
+        migrations.AlterField(
+            model_name='operationallog',
+            name='document',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='logs', to='core.document'),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:51
+
+import hashlib
+import json
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def _block_hash(block):
+    # Same hash as text_editor.apps.document.diff.block_hash
+    encoded = json.dumps(block, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(encoded.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def move_snapshot_blocks(apps, schema_editor):
+    # Store the blocks of the existing snapshots once and make the snapshots reference them
+    OperationalLog = apps.get_model('core', 'OperationalLog')
+    Block = apps.get_model('core', 'Block')
+    snapshots = OperationalLog.objects.filter(is_snapshot=True, block_refs__isnull=True).only(
+        'id', 'document_id', 'updated_content'
+    )
+    for log in snapshots.iterator(chunk_size=200):
+        content = log.updated_content
+        if not isinstance(content, dict) or not isinstance(content.get('blocks'), list):
+            continue
+        refs = [_block_hash(block) for block in content['blocks']]
+        Block.objects.bulk_create(
+            [Block(document_id=log.document_id, hash=ref, data=block) for ref, block in zip(refs, content['blocks'])],
+            batch_size=500,
+            ignore_conflicts=True,
+        )
+        OperationalLog.objects.filter(id=log.id).update(
+            updated_content={key: value for key, value in content.items() if key != 'blocks'},
+            block_refs=refs,
+        )
+
+
+def restore_snapshot_blocks(apps, schema_editor):
+    OperationalLog = apps.get_model('core', 'OperationalLog')
+    Block = apps.get_model('core', 'Block')
+    snapshots = OperationalLog.objects.filter(block_refs__isnull=False).only(
+        'id', 'document_id', 'updated_content', 'block_refs'
+    )
+    for log in snapshots.iterator(chunk_size=200):
+        blocks = dict(
+            Block.objects.filter(document_id=log.document_id, hash__in=set(log.block_refs)).values_list('hash', 'data')
+        )
+        content = dict(log.updated_content or {})
+        content['blocks'] = [blocks[ref] for ref in log.block_refs]
+        OperationalLog.objects.filter(id=log.id).update(updated_content=content, block_refs=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_operationallog_document_version_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='operationallog',
+            name='block_refs',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='Block',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=32)),
+                ('data', models.JSONField()),
+                ('document', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='blocks', to='core.document')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('document', 'hash'), name='unique_document_block')],
+            },
+        ),
+        migrations.RunPython(move_snapshot_blocks, restore_snapshot_blocks),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:02
+
+from django.db import migrations
+import text_editor.apps.core.fields
+
+
+BATCH_SIZE = 500
+
+
+def copy_field(model, source, target):
+    rows = model.objects.exclude(**{f'{source}__isnull': True}).values_list('id', source)
+    batch = []
+    for row_id, value in rows.iterator(chunk_size=BATCH_SIZE):
+        batch.append(model(id=row_id, **{target: value}))
+        if len(batch) == BATCH_SIZE:
+            model.objects.bulk_update(batch, [target])
+            batch = []
+    model.objects.bulk_update(batch, [target])
+
+
+def compress_content(apps, schema_editor):
+    copy_field(apps.get_model('core', 'Document'), 'content', 'compressed_content')
+    copy_field(apps.get_model('core', 'OperationalLog'), 'updated_content', 'compressed_updated_content')
+
+
+def decompress_content(apps, schema_editor):
+    copy_field(apps.get_model('core', 'Document'), 'compressed_content', 'content')
+    copy_field(apps.get_model('core', 'OperationalLog'), 'compressed_updated_content', 'updated_content')
+
+
+class Migration(migrations.Migration):
+    # The values are rewritten into new columns as jsonb can't be cast to bytea
+
+    dependencies = [
+        ('core', '0007_block_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='compressed_content',
+            field=text_editor.apps.core.fields.CompressedJSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='operationallog',
+            name='compressed_updated_content',
+            field=text_editor.apps.core.fields.CompressedJSONField(blank=True, null=True),
+        ),
+        migrations.RunPython(compress_content, decompress_content),
+        migrations.RemoveField(
+            model_name='document',
+            name='content',
+        ),
+        migrations.RemoveField(
+            model_name='operationallog',
+            name='updated_content',
+        ),
+        migrations.RenameField(
+            model_name='document',
+            old_name='compressed_content',
+            new_name='content',
+        ),
+        migrations.RenameField(
+            model_name='operationallog',
+            old_name='compressed_updated_content',
+            new_name='updated_content',
+        ),
+    ]
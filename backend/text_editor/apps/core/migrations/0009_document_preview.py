@@ -0,0 +1,58 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:12
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 500
+PREVIEW_LENGTH = 200
+
+
+def content_preview(content):
+    # Frozen copy of core.models.content_preview as of this migration
+    if not isinstance(content, dict):
+        return ''
+    blocks = content.get('blocks')
+    texts = [
+        block.get('content') for block in (blocks if isinstance(blocks, list) else [])
+        if isinstance(block, dict) and block.get('type') == 'text'
+    ] or [content.get('content')]
+
+    preview = ''
+    for text in texts:
+        if not isinstance(text, str) or not text.strip():
+            continue
+        preview = f'{preview} {text.strip()}' if preview else text.strip()
+        if len(preview) >= PREVIEW_LENGTH:
+            break
+    return ' '.join(preview.split())[:PREVIEW_LENGTH]
+
+
+def fill_previews(apps, schema_editor):
+    Document = apps.get_model('core', 'Document')
+    batch = []
+    for document in Document.objects.only('id', 'content').iterator(chunk_size=BATCH_SIZE):
+        document.preview = content_preview(document.content)
+        batch.append(document)
+        if len(batch) == BATCH_SIZE:
+            Document.objects.bulk_update(batch, ['preview'])
+            batch = []
+    Document.objects.bulk_update(batch, ['preview'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_compressed_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='preview',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.RunPython(fill_previews, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['user', '-updated_at', '-id'], name='document_user_updated_idx'),
+        ),
+    ]
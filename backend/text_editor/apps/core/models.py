@@ -2,6 +2,31 @@ from django.db import models
 from django.contrib.auth.models import UserManager, AbstractBaseUser,PermissionsMixin
 from django.db.models import JSONField
 from multiselectfield import MultiSelectField
+from .fields import CompressedJSONField
+
+
+# Characters of text kept in Document.preview for the document lists
+PREVIEW_LENGTH = 200
+
+
+def content_preview(content):
+    """The start of a document's text, from its text blocks; values of any other shape are skipped"""
+    if not isinstance(content, dict):
+        return ''
+    blocks = content.get('blocks')
+    texts = [
+        block.get('content') for block in (blocks if isinstance(blocks, list) else [])
+        if isinstance(block, dict) and block.get('type') == 'text'
+    ] or [content.get('content')]
+
+    preview = ''
+    for text in texts:
+        if not isinstance(text, str) or not text.strip():
+            continue
+        preview = f'{preview} {text.strip()}' if preview else text.strip()
+        if len(preview) >= PREVIEW_LENGTH:
+            break
+    return ' '.join(preview.split())[:PREVIEW_LENGTH]
 
 
 class CustomeUserManager(UserManager):
@@ -43,15 +68,28 @@ class CustomUser(AbstractBaseUser,PermissionsMixin):
 
 class Document(models.Model):
     title = models.CharField(max_length=255)
-    content = JSONField(blank=True, null=True)
+    content = CompressedJSONField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     current_version = models.IntegerField(default=1)
-   
+    # Kept with the content so listing documents doesn't load it
+    preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='')
+
+    class Meta:
+        indexes = [
+            # Document lists, most recently updated first
+            models.Index(fields=['user', '-updated_at', '-id'], name='document_user_updated_idx'),
+        ]
+
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        if 'content' not in self.get_deferred_fields():
+            self.preview = content_preview(self.content)
+        super().save(*args, **kwargs)
+
 
 class OperationalLog(models.Model):
     CHOICES = (
@@ -60,19 +98,36 @@ class OperationalLog(models.Model):
         ('undo', 'Undo'),
         ('redo', 'Redo'),
         ('image_insert', 'Image Insert'),
-        ('image_delete', 'Image Delete')
+        ('image_delete', 'Image Delete'),
+        ('delta', 'Delta'),
     )
 
-    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='logs')
+    # Indexed by the (document, version) constraint below
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='logs', db_index=False)
     operation = models.CharField(max_length=255, choices=CHOICES)
     version = models.IntegerField(default=1)
-    updated_content = JSONField(blank=True)
+    # Full content, only stored on snapshot rows; other rows keep their delta in operation_data
+    updated_content = CompressedJSONField(blank=True, null=True)
+    # Hashes of the snapshot's blocks, stored once in Block; updated_content then holds the other fields
+    block_refs = JSONField(blank=True, null=True)
+    is_snapshot = models.BooleanField(default=False)
     timestamp = models.DateTimeField(auto_now_add=True)
     position = models.IntegerField(null=True, blank=True)
     operation_data = JSONField(null=True, blank=True)
 
     class Meta:
         ordering = ['version']
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'version'], name='unique_document_version'),
+        ]
+        indexes = [
+            # Nearest snapshot lookups when rebuilding a version
+            models.Index(
+                fields=['document', 'version'],
+                condition=models.Q(is_snapshot=True),
+                name='operationallog_snapshot_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.document.title} - v{self.version} - {self.operation}"
@@ -92,6 +147,21 @@ class OperationalLog(models.Model):
         )
     
 
+class Block(models.Model):
+    """A block of a document, stored once by content hash and shared by every snapshot using it"""
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='blocks', db_index=False)
+    hash = models.CharField(max_length=32)
+    data = JSONField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'hash'], name='unique_document_block'),
+        ]
+
+    def __str__(self):
+        return f"{self.document_id} - {self.hash}"
+
+
 class DocumentAccessToken(models.Model):
     PERMISSIONS = (
         ('read', 'Read'),
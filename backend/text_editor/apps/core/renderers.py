@@ -0,0 +1,49 @@
+from functools import lru_cache
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from . import codec
+
+
+@lru_cache(maxsize=None)
+def encoder_default(encoder_class):
+    """The `default` method of one shared instance of a JSON encoder class"""
+    return encoder_class().default
+
+
+class CodecJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer encoding with the configured JSON codec.
+
+    Indented output, asked for by the browsable API or an `indent` media type
+    parameter, still goes through DRF's renderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = codec.dumps_bytes(data, default=encoder_default(self.encoder_class))
+        # Same escaping as DRF, these are valid JSON but not valid JavaScript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class CodecJSONParser(JSONParser):
+    """JSONParser decoding with the configured JSON codec"""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+
+        try:
+            data = stream.read()
+            if encoding.lower().replace('-', '') != 'utf8':
+                data = data.decode(encoding)
+            return codec.loads(data)
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
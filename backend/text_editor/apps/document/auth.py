@@ -0,0 +1,198 @@
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_delete, post_save
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from text_editor.apps.core.models import Document, DocumentAccessToken
+
+User = get_user_model()
+
+
+AUTH_CACHE_DEFAULTS = {
+    'TTL': 60,
+    'SHARED_LINK_TTL': 5,
+    'MAX_SIZE': 10000,
+}
+
+
+def auth_cache_setting(name):
+    """Read an option of settings.WEBSOCKET_AUTH_CACHE, falling back to the defaults"""
+    options = getattr(settings, 'WEBSOCKET_AUTH_CACHE', {})
+    return options.get(name, AUTH_CACHE_DEFAULTS[name])
+
+
+class TTLCache:
+    """
+    Values kept `ttl` seconds after they are set, the least recently set
+    dropped past `max_size`. Safe to use from the event loop and the threads
+    running signal handlers.
+    """
+    _missing = object()
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        """Drop the keys matching a predicate, for invalidations that don't know every key"""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Users by id (None when missing or inactive), whether a user can open a
+# document by (user id, document id), and shared links by shared id. Each
+# process has its own; changes made elsewhere are picked up when the entries
+# expire. Shared links expire sooner: revoking one must lock out its guests on
+# every worker, not only on the one that handled the request.
+principals = TTLCache(auth_cache_setting('TTL'), auth_cache_setting('MAX_SIZE'))
+document_access = TTLCache(auth_cache_setting('TTL'), auth_cache_setting('MAX_SIZE'))
+shared_links = TTLCache(auth_cache_setting('SHARED_LINK_TTL'), auth_cache_setting('MAX_SIZE'))
+
+
+def token_user_id(token):
+    """User id of a valid access token, None for a missing, expired or forged one"""
+    if not token:
+        return None
+    try:
+        return AccessToken(token).get(jwt_settings.USER_ID_CLAIM)
+    except TokenError:
+        return None
+
+
+@database_sync_to_async
+def load_user(user_id):
+    return User.objects.filter(id=user_id, is_active=True).first()
+
+
+async def get_principal(user_id):
+    user = principals.get(user_id, TTLCache._missing)
+    if user is TTLCache._missing:
+        user = await load_user(user_id)
+        principals.set(user_id, user)
+    return user
+
+
+@database_sync_to_async
+def owns_document(user_id, document_id):
+    return Document.objects.filter(id=document_id, user_id=user_id).exists()
+
+
+async def can_access_document(user, document_id):
+    """Whether an authenticated user can edit a document, only its owner can"""
+    try:
+        document_id = int(document_id)
+    except (TypeError, ValueError):
+        return False
+    key = (user.id, document_id)
+    allowed = document_access.get(key)
+    if allowed is None:
+        allowed = await owns_document(user.id, document_id)
+        document_access.set(key, allowed)
+    return allowed
+
+
+@database_sync_to_async
+def load_shared_link(shared_id):
+    token = DocumentAccessToken.objects.select_related('document__user').filter(shared_id=shared_id).first()
+    if token is None:
+        return None
+    return token.document_id, token.document.user, tuple(token.permissions)
+
+
+async def resolve_shared_link(shared_id):
+    """(document id, owner, permissions) of a shared link, None when it doesn't exist"""
+    link = shared_links.get(shared_id, TTLCache._missing)
+    if link is TTLCache._missing:
+        link = await load_shared_link(shared_id)
+        shared_links.set(shared_id, link)
+    return link
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    """
+    Authenticates a socket from the `token` in its query string.
+
+    Sets scope['user'] (AnonymousUser without a valid token), on routes with a
+    document_id scope['document_access'], and on routes with a shared_id
+    scope['shared_link']. They come from the caches above, so reconnecting
+    sockets don't query the database. Wrap the consumers rather than the
+    URLRouter, the route arguments are needed.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        query_params = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+        scope['query_params'] = query_params
+
+        user_id = token_user_id(query_params.get('token', [None])[0])
+        user = await get_principal(user_id) if user_id is not None else None
+        scope['user'] = user or AnonymousUser()
+
+        route_kwargs = scope.get('url_route', {}).get('kwargs', {})
+        if route_kwargs.get('document_id') is not None:
+            scope['document_access'] = bool(user) and await can_access_document(user, route_kwargs['document_id'])
+        if route_kwargs.get('shared_id') is not None:
+            scope['shared_link'] = await resolve_shared_link(route_kwargs['shared_id'])
+
+        return await super().__call__(scope, receive, send)
+
+
+def invalidate_user(sender, instance, **kwargs):
+    principals.discard(instance.pk)
+    document_access.discard_where(lambda key: key[0] == instance.pk)
+
+
+def invalidate_document(sender, instance, **kwargs):
+    document_access.discard_where(lambda key: key[1] == instance.pk)
+
+
+def invalidate_shared_link(sender, instance, **kwargs):
+    # Rotating a link in DocumentAccessTokenView deletes the old token and creates a new one
+    shared_links.discard(instance.shared_id)
+
+
+post_save.connect(invalidate_user, sender=User, dispatch_uid='websocket_auth_user_saved')
+post_delete.connect(invalidate_user, sender=User, dispatch_uid='websocket_auth_user_deleted')
+post_save.connect(invalidate_document, sender=Document, dispatch_uid='websocket_auth_document_saved')
+post_delete.connect(invalidate_document, sender=Document, dispatch_uid='websocket_auth_document_deleted')
+post_save.connect(invalidate_shared_link, sender=DocumentAccessToken, dispatch_uid='websocket_auth_link_saved')
+post_delete.connect(invalidate_shared_link, sender=DocumentAccessToken, dispatch_uid='websocket_auth_link_deleted')
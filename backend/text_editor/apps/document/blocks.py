@@ -0,0 +1,75 @@
+from text_editor.apps.core.models import Block
+from .diff import block_hash
+
+# Hashes looked up per query when fetching blocks
+FETCH_BATCH_SIZE = 500
+
+
+def split_snapshot(content, hashes=None):
+    """
+    Split a snapshot into the fields of its log row and the blocks to store.
+
+    Returns (log_fields, blocks): log_fields sets `updated_content` to the
+    content without its blocks and `block_refs` to their hashes, and blocks
+    maps each hash to its block. `hashes` are the cached block hashes, if any.
+    """
+    blocks = content.get('blocks') if isinstance(content, dict) else None
+    if not isinstance(blocks, list):
+        # Not block structured, keep it whole
+        return {'updated_content': content, 'block_refs': None}, {}
+
+    if hashes is None:
+        hashes = [block_hash(block) for block in blocks]
+    refs = [value.hex() for value in hashes]
+
+    rest = {key: value for key, value in content.items() if key != 'blocks'}
+    return {'updated_content': rest, 'block_refs': refs}, dict(zip(refs, blocks))
+
+
+def store_blocks(document_id, blocks):
+    """Insert the blocks a document doesn't have yet"""
+    Block.objects.bulk_create(
+        [Block(document_id=document_id, hash=ref, data=block) for ref, block in blocks.items()],
+        batch_size=FETCH_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
+
+def snapshot_fields(document_id, content, hashes=None):
+    """Store the blocks of a snapshot and return the fields of its log row"""
+    fields, blocks = split_snapshot(content, hashes)
+    store_blocks(document_id, blocks)
+    return fields
+
+
+def expand_snapshot(document_id, updated_content, block_refs, known_blocks=None):
+    """
+    Rebuild the content of a snapshot row.
+
+    Only the blocks missing from `known_blocks` (hash -> block, e.g. the
+    blocks of the document held in memory) are fetched. Returns None when a
+    block is missing from the store.
+    """
+    if block_refs is None:
+        return updated_content
+
+    blocks = dict(known_blocks or {})
+    missing = list({ref for ref in block_refs if ref not in blocks})
+    for start in range(0, len(missing), FETCH_BATCH_SIZE):
+        blocks.update(
+            Block.objects.filter(document_id=document_id, hash__in=missing[start:start + FETCH_BATCH_SIZE])
+            .values_list('hash', 'data')
+        )
+
+    if any(ref not in blocks for ref in block_refs):
+        return None
+
+    content = dict(updated_content or {})
+    content['blocks'] = [blocks[ref] for ref in block_refs]
+    return content
+
+
+def known_blocks(content, hashes):
+    """Map the hashes of a content's blocks to the blocks"""
+    blocks = content.get('blocks', []) if isinstance(content, dict) else []
+    return {value.hex(): block for value, block in zip(hashes, blocks)}
@@ -1,12 +1,19 @@
-import json
+import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.consumer import AsyncConsumer
 from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
-import jwt
-from django.conf import settings
-from text_editor.apps.core.models import Document, OperationalLog, DocumentAccessToken
-from django.db import transaction
-from .utils import get_position_of_change_async
+from text_editor.apps.core import codec
+from text_editor.apps.core.models import Document
+from .utils import get_position_of_change, get_ops_since_async, reconstruct_version, reconstruct_version_async
+from .delta import apply_delta, validate_ops, op_position, DeltaError
+from .transform import transform_ops, invert_ops
+from .diff import diff_content
+from .blocks import known_blocks
+from .state import document_states, write_behind_setting, CATCH_UP_LIMIT
+from .sharding import owner_channel
+from .throttle import OperationThrottle, rate_limit_setting
+from .frames import MSGPACK_SUBPROTOCOL, BINARY_MESSAGES, pack, decode_frame
+from .viewers import viewer_group, viewer_setting, read_document
 from django.utils.timesince import timesince
 from django.utils.timezone import now
 from abc import ABC, abstractmethod
@@ -14,105 +21,408 @@ from enum import Enum
 import uuid
 
 
-User = get_user_model()
-
-
 class UserRole(Enum):
     READER = "Reader"
     WRITER = "Writer"
 
 
-class BaseDocumentConsumer(AsyncWebsocketConsumer, ABC):
-    role = None
+class DocumentOperationsMixin(ABC):
+    """
+    Applies client operations to the hot state of a document.
 
-    @abstractmethod
-    async def connect(self):
-        pass
+    Used by the socket consumers when their process owns the document, and by
+    ShardOperation when documents are sharded across workers. `reply`
+    answers the client that sent the operation, and `history_key` names the
+    undo history its edits go to (None to not record them).
+    """
+    state = None
+    room_group_name = None
+    reply_channel = None
+    history_key = None
 
     @abstractmethod
-    async def receive(self, text_data):
+    async def reply(self, message):
         pass
 
-    async def disconnect(self, close_code):
-        """Handle WebSocket disconnection"""
-        if self.room_group_name:  # Simply check if it's not None
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+    async def handle_operation(self, data):
+        """Apply an operation received from a client, in order with the rest of the room"""
+        await self.state.sequence(self.apply_operation, data)
+
+    async def apply_operation(self, data):
+        operation_type = data.get('type')
+        content = data.get('content')
+        position = data.get('position')
+
+        if operation_type == 'UPDATE':
+            await self.handle_update(content, data.get('version'))
+
+        elif operation_type == 'DELTA':
+            await self.handle_delta(data)
+
+        elif operation_type == 'IMAGE_INSERT':
+            # Handle image insertion
+            await self.handle_image_insert(content, position)
 
-    async def document_update(self, event):
-        await self.send(text_data=json.dumps({
+        elif operation_type == 'UNDO':
+            await self.handle_undo(data)
+
+        elif operation_type == 'REDO':
+            await self.handle_redo(data)
+
+    async def broadcast(self, message, acknowledge=True):
+        """
+        Send a message to every other socket of the room and acknowledge the sender.
+
+        The frame is encoded once here instead of in each consumer of the room,
+        also as MessagePack when it carries a document; the sender already has
+        the change and only gets the committed version.
+        """
+        event = {
+            'type': 'document_broadcast',
+            'text': codec.dumps(message),
+            'sender': self.reply_channel,
+            'version': message['document']['version'],
+        }
+        # Only packed for the sockets that negotiated binary frames; those of
+        # other processes serving the room are not known here and get the text
+        if message['type'] in BINARY_MESSAGES and self.state.has_binary_sockets(exclude=self.reply_channel):
+            event['bytes'] = pack(message)
+        await self.channel_layer.group_send(self.room_group_name, event)
+        if acknowledge:
+            await self.reply({
+                'type': 'ACK',
+                'version': message['document']['version'],
+            })
+
+    async def broadcast_document(self, document):
+        """Send the full document to the room as an UPDATE"""
+        await self.broadcast({
             'type': 'UPDATE',
-            'document': event['document'],
-        }))
+            'document': {
+                'id': str(document['id']),
+                'content': document['content'],
+                'version': document['version'],
+            },
+        })
+
+    async def handle_update(self, content, base_version=None):
+        """
+        Replace the document content with a full snapshot sent by the client.
+
+        A snapshot made from an older version is diffed against the content at
+        that version and its changes rebased over the ones committed since, so
+        it doesn't revert them.
+        """
+        # Process string content into proper structure
+        if isinstance(content, str):
+            structured_content = {
+                "blocks": [],
+                "type": "text",
+                "content": content
+            }
+            content = structured_content
 
-    @abstractmethod
-    async def authenticate_user(self):
-        pass
+        if isinstance(base_version, int) and not isinstance(base_version, bool) \
+                and base_version < self.state.version:
+            base_content = await self.content_at(base_version)
+            if base_content is None:
+                await self.reply({'type': 'UPDATE', 'document': self.state.snapshot()})
+                return
+            diff = diff_content(base_content, content)
+        else:
+            base_version = self.state.version
+            diff = diff_content(self.state.content, content, self.state.block_hashes)
+
+        # Only the changed blocks and text are logged and sent to the room
+        if diff is not None:
+            ops, block_hashes = diff
+            if ops and base_version < self.state.version:
+                try:
+                    ops = await self.rebase_ops(ops, base_version)
+                    content = apply_delta(self.state.content, ops) if ops else None
+                except DeltaError as e:
+                    await self.reply({'error': str(e)})
+                    return
+                if ops is None:
+                    await self.reply({'type': 'UPDATE', 'document': self.state.snapshot()})
+                    return
+                block_hashes = None
+            if not ops:
+                await self.reply({'type': 'ACK', 'version': self.state.version})
+                return
+            await self.commit_ops(
+                ops,
+                content,
+                {'base_version': self.state.version, 'ops': ops},
+                block_hashes=block_hashes,
+            )
+            return
+
+        # Other changes are logged as a full snapshot
+        position, opertype, changed_content = get_position_of_change(self.state.content, content)
+        self.commit_content(opertype, position, content)
+        document = self.state.snapshot()
+
+        if not await self.state.persisted():
+            # Dropped by a version conflict, the room was resynced instead
+            return
+        await self.broadcast_document(document)
+
+    async def handle_image_insert(self, content, position):
+        """Insert an image block at the given position"""
+        self.commit_content('image_insert', position, content)
+        document = self.state.snapshot()
+
+        if not await self.state.persisted():
+            # Dropped by a version conflict, the room was resynced instead
+            return
+        await self.broadcast_document(document)
+
+    async def handle_delta(self, data):
+        """Apply a DELTA message and fan it out to the room as a delta"""
+        base_version = data.get('base_version')
+        ops = data.get('ops')
 
-    @database_sync_to_async
-    def get_user(self, user_id):
         try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
+            validate_ops(ops)
+            ops = await self.rebase_ops(ops, base_version)
+            content = apply_delta(self.state.content, ops) if ops else None
+        except DeltaError as e:
+            await self.reply({'error': str(e)})
+            return
+
+        if ops is None:
+            # The delta can't be rebased, resync the client with a full snapshot
+            await self.reply({
+                'type': 'UPDATE',
+                'document': self.state.snapshot(),
+            })
+            return
+        if not ops:
+            # Concurrent changes already did or undid all of it
+            await self.reply({'type': 'ACK', 'version': self.state.version})
+            return
+
+        await self.commit_ops(ops, content, {'base_version': base_version, 'ops': ops})
+
+    async def commit_ops(self, ops, content, operation_data, block_hashes=None, undo=None):
+        """
+        Commit `content`, the result of applying ops, and fan the ops out to the room.
+
+        The edit is recorded in the sender's undo history. `undo` is 'UNDO' or
+        'REDO' when the ops come from that history, the sender is then answered
+        with the ops instead of an ACK.
+        """
+        inverse = None
+        if self.history_key is not None:
+            inverse = invert_ops(self.state.content if isinstance(self.state.content, dict) else {}, ops)
+
+        version = self.state.commit(
+            'delta',
+            content,
+            position=op_position(ops[0]),
+            operation_data=operation_data,
+            ops=ops,
+            block_hashes=block_hashes,
+        )
+        if inverse:
+            history = self.state.history(self.history_key)
+            if undo == 'UNDO':
+                history.redo.append((version, inverse))
+            elif undo == 'REDO':
+                history.undo.append((version, inverse))
+            else:
+                history.record(version, inverse)
+        document = self.state.snapshot()
+
+        if not await self.state.persisted():
+            return
+        message = {
+            'type': 'DELTA',
+            'document': {
+                'id': str(document['id']),
+                'base_version': document['version'] - 1,
+                'version': document['version'],
+                'ops': ops,
+            },
+        }
+        await self.broadcast(message, acknowledge=undo is None)
+        if undo:
+            await self.reply({'type': undo, 'success': True, 'document': message['document']})
+
+    async def rebase_ops(self, ops, base_version):
+        """
+        Rebase ops made against base_version onto the current version of the document.
+
+        Returns None when the ops can't be rebased and the client must resync.
+        Must be run by the sequencer of the document.
+        """
+        if not isinstance(base_version, int) or isinstance(base_version, bool):
+            return None
+        if base_version > self.state.version:
             return None
+        if base_version == self.state.version:
+            return ops
 
-    @database_sync_to_async
-    def get_document(self, document_id):
-        try:
-            document = Document.objects.get(id=document_id)
-            # Don't manipulate the content here, just use it as is
-            content = document.content
+        concurrent_ops = await self.ops_since(base_version)
+        if concurrent_ops is None:
+            return None
 
-            return {
-                'id': str(document.id),
-                'title': document.title,
-                'content': content,
-                'version': document.current_version,
-                'last_updated': timesince(document.updated_at, now()) + " ago",
-            }
-        except Document.DoesNotExist:
+        return transform_ops(ops, concurrent_ops)
+
+    async def ops_since(self, base_version):
+        """Return the delta ops committed after base_version, or None if some version isn't a delta"""
+        ops = self.state.ops_since(base_version)
+        if ops is None:
+            # Older than what is held in memory, read it back from the log
+            await self.state.flush()
+            ops = await get_ops_since_async(self.document_id, base_version, self.state.version)
+        return ops
+
+    async def content_at(self, version):
+        """The content of the document at a past version, or None when the log can't rebuild it"""
+        await self.state.flush()
+        blocks = known_blocks(self.state.content, self.state.block_hashes)
+        return await reconstruct_version_async(self.document_id, version, blocks)
+
+    async def catch_up(self, version):
+        """
+        Return a DELTA message bringing a client that last saw `version` up to date,
+        or None when it has to be sent the whole document.
+        """
+        if version is None:
             return None
+        return await self.state.sequence(self._catch_up, version)
 
-    @database_sync_to_async
-    def get_last_log(self):
-        """Get the last operation log for the document"""
-        try:
-            last_log = OperationalLog.objects.filter(document_id=self.document_id).order_by('-version').first()
-            if last_log:
-                return {
-                    'operation': last_log.operation,
-                    'position': last_log.position,
-                    'updated_content': last_log.updated_content,
-                    'version': last_log.version,
-                }
+    async def _catch_up(self, version):
+        if version > self.state.version or self.state.version - version > CATCH_UP_LIMIT:
             return None
-        except Exception as e:
-            print(f"Error fetching last log: {e}")
+
+        ops = await self.ops_since(version) if version < self.state.version else []
+        if ops is None:
             return None
 
+        document = self.state.snapshot()
+        return {
+            'type': 'DELTA',
+            'document': {
+                'id': str(document['id']),
+                'base_version': version,
+                'version': document['version'],
+                'ops': ops,
+            },
+        }
+
+    async def undo_from_history(self, kind):
+        """
+        Undo ('UNDO') or redo ('REDO') the sender's last edit from its history.
+
+        The stored ops are rebased over what other users committed since, and
+        entries their edits made obsolete are skipped. Returns False when the
+        history is cold and the log has to be used instead.
+        """
+        history = self.state.histories.get(self.history_key)
+        if history is None:
+            return False
+
+        stack = history.undo if kind == 'UNDO' else history.redo
+        while stack:
+            version, ops = stack.pop()
+            concurrent_ops = self.state.history_ops_since(version)
+            if concurrent_ops is None:
+                concurrent_ops = await self.ops_since(version)
+            if concurrent_ops is None:
+                # A full snapshot was committed since, the history can't be rebased over it
+                del self.state.histories[self.history_key]
+                return False
+
+            ops = transform_ops(ops, concurrent_ops)
+            if not ops:
+                continue
+            try:
+                content = apply_delta(self.state.content, ops)
+            except DeltaError:
+                continue
+            if not concurrent_ops:
+                # Nothing else changed since, this commit exactly reverts the one at `version`
+                self.state.mark_reverted(version, self.state.version + 1)
+            await self.commit_ops(ops, content, {'base_version': self.state.version, 'ops': ops}, undo=kind)
+            return True
+
+        await self.reply({
+            'type': kind,
+            'success': False,
+            'message': f'Nothing to {kind.lower()}',
+        })
+        return True
+
+    async def handle_undo(self, data):
+        """Undo the sender's last edit, or go back one version of the log when its history is cold"""
+        if await self.undo_from_history('UNDO'):
+            return
+
+        await self.state.flush()
+        document_id = data.get('document_id', self.document_id)
+        version = data.get('version')
+        blocks = known_blocks(self.state.content, self.state.block_hashes)
+        success, updated_document = await self.perform_undo(document_id, version, blocks)
+        if success:
+            await self.reply({
+                'type': 'UNDO',
+                'success': True,
+                'document': updated_document,
+            })
+        else:
+            await self.reply({
+                'type': 'UNDO',
+                'success': False,
+                'message': 'Nothing to undo',
+            })
+
+    async def handle_redo(self, data):
+        """Redo the sender's last undone edit, or go forward one version of the log when its history is cold"""
+        if await self.undo_from_history('REDO'):
+            return
+
+        await self.state.flush()
+        document_id = data.get('document_id', self.document_id)
+        version = data.get('version')
+        blocks = known_blocks(self.state.content, self.state.block_hashes)
+        success, updated_document = await self.perform_redo(document_id, version, blocks)
+        if success:
+            await self.reply({
+                'type': 'REDO',
+                'success': True,
+                'document': updated_document,
+            })
+        else:
+            await self.reply({
+                'type': 'REDO',
+                'success': False,
+                'message': 'Nothing to redo',
+            })
+
     @database_sync_to_async
-    def perform_undo(self, document_id, version):
+    def perform_undo(self, document_id, version, known_blocks=None):
         """Perform undo operation by fetching the previous log entry"""
         try:
-            # Get the document
-            document = Document.objects.get(id=document_id)
+            # Get the document, skipping its content which is rebuilt from the log
+            document = Document.objects.values('id', 'title', 'updated_at').get(id=document_id)
 
-            # Fetch the log entry for the specified version
-            log_entry = OperationalLog.objects.filter(document=document, version=version - 1).first()
-            if not log_entry:
+            # Rebuild the content of the requested version from the log, reading only the blocks not in memory
+            content = reconstruct_version(document['id'], version - 1, known_blocks)
+            if content is None:
                 print("No previous log entry found for undo")
                 return False, None
 
             # Ensure `updated_at` is a datetime object and calculate human-readable time
-            last_updated_human = timesince(document.updated_at, now()) + " ago"
+            last_updated_human = timesince(document['updated_at'], now()) + " ago"
             updated_document = {
-                'id': str(document.id),
-                'title': document.title,
-                'content': log_entry.updated_content,
+                'id': str(document['id']),
+                'title': document['title'],
+                'content': content,
                 'last_updated': last_updated_human,
-                'version': log_entry.version,
+                'version': version - 1,
             }
             return True, updated_document
 
@@ -123,26 +433,26 @@ class BaseDocumentConsumer(AsyncWebsocketConsumer, ABC):
             return False, None
 
     @database_sync_to_async
-    def perform_redo(self, document_id, version):
+    def perform_redo(self, document_id, version, known_blocks=None):
         """Perform redo operation by fetching the next log entry"""
         try:
-            # Get the document
-            document = Document.objects.get(id=document_id)
+            # Get the document, skipping its content which is rebuilt from the log
+            document = Document.objects.values('id', 'title', 'updated_at').get(id=document_id)
 
-            # Fetch the log entry for the specified version
-            log_entry = OperationalLog.objects.filter(document=document, version=version + 1).first()
-            if not log_entry:
+            # Rebuild the content of the requested version from the log, reading only the blocks not in memory
+            content = reconstruct_version(document['id'], version + 1, known_blocks)
+            if content is None:
                 print("No next log entry found for redo")
                 return False, None
 
             # Ensure `updated_at` is a datetime object and calculate human-readable time
-            last_updated_human = timesince(document.updated_at, now()) + " ago"
+            last_updated_human = timesince(document['updated_at'], now()) + " ago"
             updated_document = {
-                'id': str(document.id),
-                'title': document.title,
-                'content': log_entry.updated_content,
+                'id': str(document['id']),
+                'title': document['title'],
+                'content': content,
                 'last_updated': last_updated_human,
-                'version': log_entry.version,
+                'version': version + 1,
             }
             return True, updated_document
 
@@ -152,44 +462,23 @@ class BaseDocumentConsumer(AsyncWebsocketConsumer, ABC):
             traceback.print_exc()
             return False, None
 
-    @database_sync_to_async
-    def save_operation(self, document_id, operation_type, position, new_content, last_version_log):
-        """Save operation log and update document if needed exceed the 50 version"""
-        with transaction.atomic():
-            try:
-                # Get the document
-                document = Document.objects.get(id=document_id)
-
-                # Process the content based on operation type
-                processed_content = self._process_content(operation_type, new_content, position)
-                print("processed_content", processed_content)   
-                # Create operation log with additional metadata
-                operation_data = {
-                    'position': position,
-                    'content_type': processed_content.get('type', 'text'),
-                    'block_id': processed_content.get('block_id', str(uuid.uuid4()))
-                }
-
-                OperationalLog.objects.create(
-                    document_id=document_id,
-                    operation=operation_type,
-                    position=position,
-                    version=last_version_log + 1,
-                    updated_content=processed_content,
-                    operation_data=operation_data
-                )
-
-                # Always update document with new content
-                document.content = processed_content
-
-                # Increment document version
-                document.current_version += 1
-                document.save()
-
-                return True
-            except Exception as e:
-                print(f"Error saving operation: {e}")
-                return False
+    def commit_content(self, operation_type, position, new_content):
+        """Process the content and commit it as the next version of the document"""
+        processed_content = self._process_content(operation_type, new_content, position)
+        print("processed_content", processed_content)
+        # Create operation log with additional metadata
+        operation_data = {
+            'position': position,
+            'content_type': processed_content.get('type', 'text'),
+            'block_id': processed_content.get('block_id', str(uuid.uuid4()))
+        }
+
+        return self.state.commit(
+            operation_type,
+            processed_content,
+            position=position,
+            operation_data=operation_data,
+        )
 
     def _process_content(self, operation_type, content, position):
         """Process and structure the content based on its type"""
@@ -251,341 +540,526 @@ class BaseDocumentConsumer(AsyncWebsocketConsumer, ABC):
             return content
 
 
-class DocumentConsumer(BaseDocumentConsumer):
-    role = UserRole.WRITER  # Define role as WRITER (Owner)
+class BaseDocumentConsumer(DocumentOperationsMixin, AsyncWebsocketConsumer, ABC):
+    role = None
+    owner_channel = None
+    throttle = None
+    pending_update = None
+    binary_frames = False
+    _coalesce_task = None
 
-    async def connect(self):
-        """Handle new WebSocket connection with token authentication"""
-        # Extract token from query string
-        query_string = self.scope.get('query_string', b'').decode('utf-8')
-        print(f"Query params: {query_string}")
-        query_params = dict(param.split('=') for param in query_string.split('&') if '=' in param)
-        token = query_params.get('token', None)
-        print(f"Token: {token}")
-        if not token:
-            # Reject connection if no token provided
-            await self.close()
-            return
+    @property
+    def reply_channel(self):
+        return self.channel_name
 
-        try:
-            # Verify JWT token
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-            print(f"Payload: {payload}")
-            user_id = payload.get('user_id')
-            print(f"User ID: {user_id}")
-            if not user_id:
-                await self.close()
-                return
+    @abstractmethod
+    async def connect(self):
+        pass
 
-            # Authenticate user
-            self.user = await self.get_user(user_id)
-            print(f"User: {self.user}")
-            if not self.user:
-                await self.close()
-                return
+    @abstractmethod
+    async def receive(self, text_data=None, bytes_data=None):
+        pass
 
-            # Get document ID from URL route
-            self.document_id = self.scope['url_route']['kwargs'].get('document_id')
-            if not self.document_id:
-                print("Document ID not found in URL route")
-                await self.close()
-                return
+    @abstractmethod
+    async def send_initialize(self, document):
+        pass
 
-            # Initialize room group name
-            self.room_group_name = f'document_{self.document_id}'
-            print(f"Room group name: {self.room_group_name}")
+    async def disconnect(self, close_code):
+        """Handle WebSocket disconnection"""
+        if self._coalesce_task:
+            # An update the task already took out of pending_update is applied
+            # under the lock, cancelling it then would drop the update
+            async with self._submit_lock:
+                self._coalesce_task.cancel()
+        if self.pending_update:
+            # Apply the last edit instead of waiting for the coalescing window
+            await self.flush_update()
 
-            # Join room group
-            await self.channel_layer.group_add(
+        if self.room_group_name:  # Simply check if it's not None
+            await self.channel_layer.group_discard(
                 self.room_group_name,
                 self.channel_name
             )
 
-            # Accept the connection
-            await self.accept()
-
-            # Get the document content or the last log
-            last_log = await self.get_last_log()
-
-            if last_log:
-                print("last_log", last_log)
-                # Send the last log to the newly connected user
-                await self.send(text_data=json.dumps({
-                    'type': 'INITIALIZE',
-                    'document': {
-                        'id': str(self.document_id),
-                        'content': last_log['updated_content'],
-                        'version': last_log['version'],
-                    },
-                }))
-            else:
-                # Send the document content to the newly connected user
-                document = await self.get_document(self.document_id)
-                if not document:
-                    await self.close()
-                    return
-                await self.send(text_data=json.dumps({
-                    'type': 'INITIALIZE',
-                    'document': {
-                        'id': str(document['id']),
-                        'content': document['content'],
-                        'version': document['version'],
-                    },
-                }))
-
-        except jwt.PyJWTError as e:
-            # Reject connection if token is invalid
-            print("Invalid token", e)
-            await self.close()
-            
+        if self.owner_channel:
+            await self.channel_layer.send(self.owner_channel, {
+                'type': 'document.leave',
+                'document_id': str(self.document_id),
+                'reply_channel': self.channel_name,
+            })
+        elif self.state:
+            await document_states.release(self.document_id, self.channel_name)
+
+    async def join_document(self):
+        """Join the room group of the document, loading its hot state unless another worker owns it"""
+        self.owner_channel = owner_channel(self.document_id)
+        self.binary_frames = MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        if not self.owner_channel:
+            self.state = await document_states.acquire(self.document_id, self.channel_name, self.binary_frames)
+            if not self.state:
+                return False
 
-    async def authenticate_user(self):
-        query_string = self.scope.get('query_string', b'').decode('utf-8')
-        query_params = dict(param.split('=') for param in query_string.split('&') if '=' in param)
-        token = query_params.get('token')
+        # Initialize room group name
+        self.room_group_name = f'document_{self.document_id}'
+        print(f"Room group name: {self.room_group_name}")
 
-        if not token:
-            return None
+        # Join room group
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+        self.throttle = OperationThrottle(self.document_id)
+        self._submit_lock = asyncio.Lock()
+        return True
 
+    def requested_version(self):
+        """Version the client already has, sent in the query string when it reconnects"""
         try:
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-            user_id = payload.get('user_id')
-            return await self.get_user(user_id)
-        except jwt.PyJWTError:
+            return int(self.scope['query_params']['version'][0])
+        except (KeyError, ValueError):
             return None
 
-    async def disconnect(self, close_code):
-        """Handle WebSocket disconnection"""
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+    async def initialize(self):
+        """
+        Send the current document to the newly connected user, or only the
+        operations it missed when it reconnects with a recent version.
+        """
+        version = self.requested_version()
+        if self.owner_channel:
+            # The owner answers with a document.reply or document.initialize message
+            await self.channel_layer.send(self.owner_channel, {
+                'type': 'document.join',
+                'document_id': str(self.document_id),
+                'reply_channel': self.channel_name,
+                'binary_frames': self.binary_frames,
+                'version': version,
+            })
+            return
 
-    async def receive(self, text_data):
-        """Handle messages received from WebSocket Client"""
-        if self.role != UserRole.WRITER:
-            await self.send(text_data=json.dumps({'error': 'Permission denied'}))
+        message = await self.catch_up(version)
+        if message:
+            await self.reply(message)
+        else:
+            await self.send_initialize(self.state.snapshot())
+
+    async def receive_operation(self, data):
+        """
+        Coalesce and rate limit the operations of this socket before applying them.
+
+        UPDATEs carry the whole document, so only the latest one received within
+        COALESCE_WINDOW is applied, and it waits for the rate limits instead of
+        being rejected. Other operations over the limits are rejected with a
+        THROTTLE message telling the client when to retry.
+        """
+        if data.get('type') == 'UPDATE':
+            self.pending_update = data
+            if self._coalesce_task is None or self._coalesce_task.done():
+                self._coalesce_task = asyncio.ensure_future(self._coalesce_updates())
             return
 
-        data = json.loads(text_data)
-        print("Received data:", data)
+        wait = self.throttle.take()
+        if wait:
+            await self.reply({'type': 'THROTTLE', 'retry_after': round(wait, 3), 'rejected': data.get('type')})
+            return
 
-        operation_type = data.get('type')
-        content = data.get('content')
-        position = data.get('position')
+        # Keep the order of operations: a buffered update goes first
+        await self.flush_update()
+        await self.submit_operation(data)
+
+    async def _coalesce_updates(self):
+        # An update received while the previous one was being applied is picked up by the next round
+        while self.pending_update:
+            await asyncio.sleep(rate_limit_setting('COALESCE_WINDOW'))
+            throttled = False
+            while self.pending_update:
+                wait = self.throttle.take()
+                if not wait:
+                    await self.flush_update()
+                    break
+                if not throttled:
+                    # Ask the client to slow down; its updates keep being merged meanwhile
+                    throttled = True
+                    await self.reply({'type': 'THROTTLE', 'retry_after': round(wait, 3)})
+                await asyncio.sleep(wait)
+
+    async def flush_update(self):
+        """Apply the buffered update, if any"""
+        async with self._submit_lock:
+            data, self.pending_update = self.pending_update, None
+            if data:
+                await self.submit_operation(data)
+
+    async def submit_operation(self, data):
+        """Apply an operation here, or forward it to the worker that owns the document"""
+        if self.owner_channel:
+            await self.channel_layer.send(self.owner_channel, {
+                'type': 'document.operation',
+                'document_id': str(self.document_id),
+                'reply_channel': self.channel_name,
+                'history_key': self.history_key,
+                'data': data,
+            })
+        else:
+            await self.handle_operation(data)
 
-        if operation_type == 'UPDATE':
-            # Process string content into proper structure
-            if isinstance(content, str):
-                structured_content = {
-                    "blocks": [],
-                    "type": "text",
-                    "content": content
-                }
-                content = structured_content
-                
-            # Process operation of update document content
-            position, opertype, changed_content, last_version_log = await get_position_of_change_async(self.document_id, content)
-            success = await self.save_operation(self.document_id, opertype, position, content, last_version_log)
-            if not success:
-                print(f"Failed to save operation for document_id: {self.document_id}")
-                return
+    async def accept_connection(self):
+        """Accept the socket, with binary frames if the client offered the MessagePack subprotocol"""
+        self.binary_frames = MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        if self.binary_frames:
+            await self.accept(MSGPACK_SUBPROTOCOL)
+        else:
+            await self.accept()
 
-            # Build the last version of the document
-            document = await self.get_document(self.document_id)
-            if not document:
-                await self.close()
-                return
+    async def send_message(self, message):
+        """Send a message as JSON text, or as a MessagePack binary frame when it carries a document and was negotiated"""
+        if self.binary_frames and message.get('type') in BINARY_MESSAGES:
+            await self.send(bytes_data=pack(message))
+        else:
+            await self.send(text_data=codec.dumps(message))
 
-            # Send message to room group using the document_update method.
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'document_update',
-                    'document': {
-                        'id': str(document['id']),
-                        'content': document['content'],
-                        'version': document['version'],
-                    },
-                }
-            )
+    async def reply(self, message):
+        await self.send_message(message)
 
-        elif operation_type == 'IMAGE_INSERT':
-            # Handle image insertion
-            success = await self.save_operation(self.document_id, 'image_insert', position, content, document['version'])
-            if success:
-                document = await self.get_document(self.document_id)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'document_update',
-                        'document': {
-                            'id': str(document['id']),
-                            'content': document['content'],
-                            'version': document['version'],
-                        },
-                    }
-                )
+    async def document_initialize(self, event):
+        if not event['document']:
+            await self.close()
+            return
+        await self.send_initialize(event['document'])
 
-        elif operation_type == 'UNDO':
-            # Process undo operation
-            document_id = data.get('document_id', self.document_id)
-            version = data.get('version')
-            success, updated_document = await self.perform_undo(document_id, version)
-            if success:
-                await self.send(text_data=json.dumps({
-                    'type': 'UNDO',
-                    'success': True,
-                    'document': updated_document,
-                }))
-            else:
-                await self.send(text_data=json.dumps({
-                    'type': 'UNDO',
-                    'success': False,
-                    'message': 'Nothing to undo',
-                }))
+    async def document_reply(self, event):
+        await self.send_message(event['message'])
 
-        elif operation_type == 'REDO':
-            # Process redo operation
-            document_id = data.get('document_id', self.document_id)
-            version = data.get('version')
-            success, updated_document = await self.perform_redo(document_id, version)
-            if success:
-                await self.send(text_data=json.dumps({
-                    'type': 'REDO',
-                    'success': True,
-                    'document': updated_document,
-                }))
-            else:
-                await self.send(text_data=json.dumps({
-                    'type': 'REDO',
-                    'success': False,
-                    'message': 'Nothing to redo',
-                }))
+    async def document_broadcast(self, event):
+        """Forward a frame encoded once by the broadcaster, skipping the echo to its sender"""
+        if event['sender'] == self.channel_name:
+            return
+        if self.state and event.get('version') == self.state.version + 1:
+            # Committed by another process serving the room, keep the state of this one along
+            await self.state.sequence(self.follow_broadcast, event)
+        if self.binary_frames and 'bytes' in event:
+            await self.send(bytes_data=event['bytes'])
+        else:
+            await self.send(text_data=event['text'])
+
+    async def follow_broadcast(self, event):
+        self.state.follow(codec.loads(event['text'])['document'])
+
+    async def document_viewer(self, event):
+        """A viewer joined, left or is out of sync, see ViewerPublisher.handle"""
+        if self.state:
+            self.state.viewers.handle(event)
+
+
+class DocumentConsumer(BaseDocumentConsumer):
+    role = UserRole.WRITER  # Define role as WRITER (Owner)
+
+    async def connect(self):
+        """Handle new WebSocket connection, authenticated by TokenAuthMiddleware"""
+        self.user = self.scope['user']
+        self.document_id = self.scope['url_route']['kwargs'].get('document_id')
+        if not self.user.is_authenticated or not self.scope.get('document_access'):
+            # Reject connection without a valid token or for another user's document
+            await self.close()
+            return
+        # Undo and redo apply to the edits of this user only
+        self.history_key = self.user.id
+
+        # Load the document and join its room group
+        if not await self.join_document():
+            await self.close()
+            return
+
+        # Accept the connection
+        await self.accept_connection()
+
+        # Send the document content to the newly connected user
+        await self.initialize()
+
+    async def send_initialize(self, document):
+        await self.send_message({
+            'type': 'INITIALIZE',
+            'document': {
+                'id': str(document['id']),
+                'content': document['content'],
+                'version': document['version'],
+            },
+        })
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """Handle messages received from WebSocket Client"""
+        if self.role != UserRole.WRITER:
+            await self.send(text_data=codec.dumps({'error': 'Permission denied'}))
+            return
 
+        data = decode_frame(text_data, bytes_data)
+        print("Received data:", data)
 
+        await self.receive_operation(data)
 
 
 class GuestDocumentConsumer(BaseDocumentConsumer):
+    user = None
     role = None  # Role will be determined based on the token
 
     async def connect(self):
         """Handle new WebSocket connection with token-based permissions"""
-        print("guest hello")
-        self.user, self.role,self.document_id = await self.authenticate_user()
+        link = self.scope.get('shared_link')
+        if link:
+            # Guests act on behalf of the document owner
+            self.document_id, self.user, permissions = link
+            if 'write' in permissions:
+                self.role = UserRole.WRITER
+            elif 'read' in permissions:
+                self.role = UserRole.READER
         print(f"User: {self.user}, Role: {self.role}")
 
         if not self.user or not self.role:
             await self.close()
             return
 
-        # Get document ID from URL route
-
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
-
-        document = await self.get_document(self.document_id)
-        if document:
-            print("test",self.role)
-            await self.send(text_data=json.dumps({'type': 'INITIALIZE', 'document': document,'role': self.role}))
-        else:
+        # Load the document and join its room group
+        if not await self.join_document():
             await self.close()
+            return
 
-    @database_sync_to_async
-    def authenticate_user(self):
-        """Authenticate user and determine role based on token"""
-        
-        shared_id_value = self.scope['url_route']['kwargs'].get('shared_id')
-        print("hello from the shared ", shared_id_value)
-        if not shared_id_value:
-            return None, None, None  # Make sure to return 3 values
+        await self.accept_connection()
 
-        try:
-            token = DocumentAccessToken.objects.get(shared_id=shared_id_value)
-            print("shared id permissions:", token.permissions)
-            
-            # Initialize room_group_name here
-            self.room_group_name = f'document_{token.document.id}'
-            
-            # Check permissions correctly - MultiSelectField stores as comma-separated string
-            if 'write' in token.permissions:
-                print("Giving writer access")
-                return token.document.user, UserRole.WRITER.value, token.document.id
-            elif 'read' in token.permissions:
-                print("Giving reader access")
-                return token.document.user, UserRole.READER.value, token.document.id
-            else:
-                print("No valid permissions")
-                return None, None, None
-        except DocumentAccessToken.DoesNotExist:
-            print("Token not found")
-            return None, None, None
+        await self.initialize()
+
+    async def send_initialize(self, document):
+        await self.send_message({'type': 'INITIALIZE', 'document': document, 'role': self.role.value})
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Handle messages received from WebSocket Client"""
         if self.role == UserRole.READER:
-            await self.send(text_data=json.dumps({'error': 'Permission denied: Read-only access'}))
+            await self.send(text_data=codec.dumps({'error': 'Permission denied: Read-only access'}))
             return
 
         if self.role == UserRole.WRITER:
-            data = json.loads(text_data)
-            operation_type = data.get('type')
-            content = data.get('content')
-            position = data.get('position')
-
-            if operation_type == 'UPDATE':
-                # Process string content into proper structure
-                if isinstance(content, str):
-                    structured_content = {
-                        "blocks": [],
-                        "type": "text",
-                        "content": content
-                    }
-                    content = structured_content
-                
-                position, opertype, changed_content, last_version_log = await get_position_of_change_async(self.document_id, content)
-                success = await self.save_operation(self.document_id, opertype, position, content, last_version_log)
-                if not success:
-                    return
+            data = decode_frame(text_data, bytes_data)
+            # Guests can edit but not undo or redo
+            if data.get('type') in ('UPDATE', 'DELTA', 'IMAGE_INSERT'):
+                await self.receive_operation(data)
+
+
+class DocumentViewerConsumer(BaseDocumentConsumer):
+    """
+    Read-only socket of a shared link, in the viewer tier.
+
+    Viewers don't join the room of the writers or load the hot state. They get
+    the document from the hot state of this process or the stored row, then
+    the changes published at most DOCUMENT_VIEWERS['RATE'] times per second
+    to the viewer group by the process owning the document. They never write,
+    so they can be served by workers dedicated to them.
+    """
+    role = UserRole.READER
+    user = None
+    version = None
+    out_of_sync = False
+    viewer_group_name = None
+    _resync_task = None
 
-                document = await self.get_document(self.document_id)
-                if not document:
-                    await self.close()
-                    return
+    async def connect(self):
+        link = self.scope.get('shared_link')
+        if not link:
+            await self.close()
+            return
+        self.document_id, self.user, _ = link
 
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'document_update',
-                        'document': {
-                            'id': str(document['id']),
-                            'content': document['content'],
-                            'version': document['version'],
-                        },
-                    }
-                )
-
-            elif operation_type == 'IMAGE_INSERT':
-                # Handle image insertion
-                success = await self.save_operation(self.document_id, 'image_insert', position, content, document['version'])
-                if success:
-                    document = await self.get_document(self.document_id)
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'document_update',
-                            'document': {
-                                'id': str(document['id']),
-                                'content': document['content'],
-                                'version': document['version'],
-                            },
-                        }
-                    )
+        # Join before reading the document, changes published meanwhile are skipped by version
+        self.viewer_group_name = viewer_group(self.document_id)
+        await self.channel_layer.group_add(self.viewer_group_name, self.channel_name)
 
-    async def document_update(self, event):
-        """Handle document updates and broadcast to all connected users"""
-        await self.send(text_data=json.dumps({
-            'type': 'UPDATE',
-            'document': event['document'],
-        }))
+        document = await self.read_document()
+        if document is None:
+            await self.close()
+            return
+
+        await self.accept_connection()
+        await self.send_initialize(document)
+        await self.notify_owner('join')
+
+    async def disconnect(self, close_code):
+        if self._resync_task:
+            self._resync_task.cancel()
+        if self.viewer_group_name:
+            await self.channel_layer.group_discard(self.viewer_group_name, self.channel_name)
+            if self.version is not None:
+                await self.notify_owner('leave')
+
+    async def notify_owner(self, action):
+        """Tell the process holding the hot state that this viewer joined, left or is out of sync"""
+        message = {
+            'type': 'document.viewer',
+            'action': action,
+            'document_id': str(self.document_id),
+            'viewer_channel': self.channel_name,
+            'binary_frames': self.binary_frames,
+        }
+        owner = owner_channel(self.document_id)
+        if owner:
+            await self.channel_layer.send(owner, message)
+        else:
+            await self.channel_layer.group_send(f'document_{self.document_id}', message)
+
+    async def viewer_announce(self, event):
+        """The document was loaded after this viewer connected"""
+        if self.version is not None:
+            await self.notify_owner('join')
+
+    async def read_document(self):
+        state = document_states.get(self.document_id)
+        if state:
+            return state.snapshot()
+        return await read_document(self.document_id)
+
+    async def send_initialize(self, document):
+        self.version = document['version']
+        await self.send_message({'type': 'INITIALIZE', 'document': document, 'role': self.role.value})
+
+    async def receive(self, text_data=None, bytes_data=None):
+        await self.send(text_data=codec.dumps({'error': 'Permission denied: Read-only access'}))
+
+    async def viewer_update(self, event):
+        """Forward the changes published for the viewers, or the whole document when they don't follow our version"""
+        if self.version is None:
+            return
+        if event.get('reset') or event['version'] > self.version:
+            if 'delta' in event and event['base_version'] == self.version and not event.get('reset'):
+                frames = event['delta']
+            elif 'snapshot' in event:
+                frames = event['snapshot']
+            else:
+                await self.request_resync()
+                return
+            self.version = event['version']
+            self.out_of_sync = False
+            await self.send_frames(frames)
+
+    async def send_frames(self, frames):
+        if self.binary_frames and 'bytes' in frames:
+            await self.send(bytes_data=frames['bytes'])
+        else:
+            await self.send(text_data=frames['text'])
+
+    async def request_resync(self):
+        """Ask the owner of the document for a keyframe, and read the stored document if none comes"""
+        self.out_of_sync = True
+        if self._resync_task and not self._resync_task.done():
+            return
+
+        await self.notify_owner('sync')
+        self._resync_task = asyncio.ensure_future(self._resync_from_database())
+
+    async def _resync_from_database(self):
+        """The document may not be hot anywhere anymore, its last version is then stored"""
+        rate = viewer_setting('RATE')
+        await asyncio.sleep((1 / rate if rate > 0 else 0) + write_behind_setting('FLUSH_INTERVAL'))
+        if not self.out_of_sync:
+            return
+        document = await read_document(self.document_id)
+        if document and document['version'] > self.version:
+            self.version = document['version']
+            await self.send_message({
+                'type': 'UPDATE',
+                'document': {'id': document['id'], 'content': document['content'], 'version': document['version']},
+            })
+
+
+class ShardOperation(DocumentOperationsMixin):
+    """
+    A message handled by a shard worker, with the document, state and socket
+    the operation handlers act on, so messages of different documents handled
+    at the same time don't share them.
+    """
+
+    def __init__(self, channel_layer, message, state):
+        self.channel_layer = channel_layer
+        self.document_id = message['document_id']
+        self.reply_channel = message['reply_channel']
+        self.history_key = message.get('history_key')
+        self.room_group_name = f'document_{self.document_id}'
+        self.state = state
+
+    async def reply(self, message):
+        await self.channel_layer.send(self.reply_channel, {
+            'type': 'document.reply',
+            'message': message,
+        })
+
+
+class DocumentShardConsumer(AsyncConsumer):
+    """
+    Owns the hot state of the documents hashed to one shard.
+
+    Socket consumers on every worker forward joins, leaves and operations to
+    the owner's channel, so each document is ordered, diffed and persisted in
+    a single process. Each document has its own queue of messages, so a slow
+    document doesn't hold the others back. Run one per name in DOCUMENT_SHARDS
+    with `python manage.py runworker document-shard-<name>`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queues = {}
+
+    def schedule(self, handler, message):
+        """Run handler(message) on the task of its document, after the messages of that document received before it"""
+        key = str(message['document_id'])
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = asyncio.Queue()
+            asyncio.ensure_future(self._drain(key, queue))
+        queue.put_nowait((handler, message))
+
+    async def _drain(self, key, queue):
+        while not queue.empty():
+            handler, message = queue.get_nowait()
+            try:
+                await handler(message)
+            except Exception as e:
+                print(f"Error handling {message['type']} for document {key}: {e}")
+        del self.queues[key]
+
+    async def document_join(self, message):
+        self.schedule(self.join, message)
+
+    async def document_leave(self, message):
+        self.schedule(self.leave, message)
+
+    async def document_operation(self, message):
+        self.schedule(self.operation, message)
+
+    async def document_viewer(self, message):
+        state = document_states.get(message['document_id'])
+        if state:
+            state.viewers.handle(message)
+
+    async def join(self, message):
+        state = await document_states.acquire(
+            message['document_id'], message['reply_channel'], message.get('binary_frames', False)
+        )
+        if state:
+            operation = ShardOperation(self.channel_layer, message, state)
+            catch_up = await operation.catch_up(message.get('version'))
+            if catch_up:
+                await operation.reply(catch_up)
+                return
+
+        await self.channel_layer.send(message['reply_channel'], {
+            'type': 'document.initialize',
+            'document': state.snapshot() if state else None,
+        })
+
+    async def leave(self, message):
+        await document_states.release(message['document_id'], message['reply_channel'])
+
+    async def operation(self, message):
+        state = document_states.get(message['document_id'])
+        if not state:
+            # The shard was restarted after the socket joined
+            state = await document_states.acquire(message['document_id'], message['reply_channel'])
+            if not state:
+                return
+
+        await ShardOperation(self.channel_layer, message, state).handle_operation(message['data'])
@@ -0,0 +1,169 @@
+import copy
+
+
+INSERT = 'insert'
+DELETE = 'delete'
+REPLACE = 'replace'
+TEXT = 'text'
+FIELD_TEXT = 'field_text'
+
+OPERATIONS = (INSERT, DELETE, REPLACE, TEXT, FIELD_TEXT)
+
+
+class DeltaError(ValueError):
+    """Raised when a delta cannot be applied to the document content."""
+
+
+def empty_content():
+    """Return the default structure used for a document without content"""
+    return {
+        "blocks": [],
+        "type": "text",
+        "content": "",
+    }
+
+
+def validate_ops(ops):
+    """
+    Check the shape of a list of document operations.
+
+    Each operation is a dict of the form:
+        {'op': 'insert', 'index': 2, 'block': {...}}
+        {'op': 'replace', 'index': 2, 'block': {...}}
+        {'op': 'delete', 'index': 2}
+        {'op': 'text', 'index': 2, 'ops': [5, 'abc', -3]}
+        {'op': 'field_text', 'field': 'content', 'ops': [5, 'abc', -3]}
+
+    Text operations edit the content string of a single block. Their `ops`
+    are components applied from the start of the string: a positive int
+    retains that many characters, a negative int deletes them and a string
+    is inserted. Anything past the last component is kept as is. Field text
+    operations edit a string field of the document itself the same way, such
+    as the plain text `content` of the editor.
+    """
+    if not isinstance(ops, list) or not ops:
+        raise DeltaError("Delta must contain a non-empty list of operations")
+
+    for op in ops:
+        if not isinstance(op, dict) or op.get('op') not in OPERATIONS:
+            raise DeltaError(f"Unknown delta operation: {op!r}")
+        if op['op'] == FIELD_TEXT:
+            if not isinstance(op.get('field'), str) or op['field'] == 'blocks':
+                raise DeltaError(f"Field text operation needs a document field: {op!r}")
+            if not _valid_text_ops(op.get('ops')):
+                raise DeltaError(f"Invalid text operation: {op!r}")
+            continue
+        if not isinstance(op.get('index'), int) or isinstance(op.get('index'), bool):
+            raise DeltaError(f"Delta operation needs an integer index: {op!r}")
+        if op['op'] in (INSERT, REPLACE) and not isinstance(op.get('block'), dict):
+            raise DeltaError(f"Delta operation needs a block: {op!r}")
+        if op['op'] == TEXT and not _valid_text_ops(op.get('ops')):
+            raise DeltaError(f"Invalid text operation: {op!r}")
+
+
+def _valid_text_ops(components):
+    if not isinstance(components, list) or not components:
+        return False
+    for component in components:
+        if isinstance(component, bool):
+            return False
+        if isinstance(component, int) and component != 0:
+            continue
+        if isinstance(component, str) and component:
+            continue
+        return False
+    return True
+
+
+def apply_text_ops(text, components):
+    """Apply retain/insert/delete components to a string"""
+    result = []
+    cursor = 0
+    for component in components:
+        if isinstance(component, str):
+            result.append(component)
+        elif component > 0:
+            if cursor + component > len(text):
+                raise DeltaError("Text operation retains past the end of the text")
+            result.append(text[cursor:cursor + component])
+            cursor += component
+        else:
+            if cursor - component > len(text):
+                raise DeltaError("Text operation deletes past the end of the text")
+            cursor -= component
+    result.append(text[cursor:])
+    return ''.join(result)
+
+
+def op_position(op):
+    """Index of the block, or offset in the field, where an operation starts"""
+    if op['op'] != FIELD_TEXT:
+        return op['index']
+    first = op['ops'][0]
+    return first if isinstance(first, int) and first > 0 else 0
+
+
+def apply_field_ops(content, ops):
+    """Apply the field text operations to a document content dict, in place"""
+    for op in ops:
+        text = content.get(op['field']) or ''
+        if not isinstance(text, str):
+            raise DeltaError(f"Field {op['field']!r} is not a string")
+        content[op['field']] = apply_text_ops(text, op['ops'])
+    return content
+
+
+def apply_ops(blocks, ops):
+    """
+    Apply the block operations in order to a list of blocks, in place.
+
+    Field text operations don't touch the blocks and are skipped, see apply_field_ops.
+    """
+    for op in ops:
+        if op['op'] == FIELD_TEXT:
+            continue
+        index = op['index']
+        if op['op'] == INSERT:
+            if not 0 <= index <= len(blocks):
+                raise DeltaError(f"Insert index {index} out of range")
+            blocks.insert(index, op['block'])
+        elif op['op'] == DELETE:
+            if not 0 <= index < len(blocks):
+                raise DeltaError(f"Delete index {index} out of range")
+            blocks.pop(index)
+        elif op['op'] == REPLACE:
+            if not 0 <= index < len(blocks):
+                raise DeltaError(f"Replace index {index} out of range")
+            blocks[index] = op['block']
+        elif op['op'] == TEXT:
+            if not 0 <= index < len(blocks):
+                raise DeltaError(f"Text index {index} out of range")
+            block = dict(blocks[index])
+            block['content'] = apply_text_ops(block.get('content') or '', op['ops'])
+            blocks[index] = block
+    return blocks
+
+
+def apply_delta(content, ops):
+    """
+    Apply a delta to the document content.
+
+    Args:
+        content (dict): The content at the delta's base version (left untouched)
+        ops (list): The operations to apply
+
+    Returns:
+        dict: The new content
+    """
+    validate_ops(ops)
+
+    if isinstance(content, str):
+        content = {**empty_content(), "content": content}
+    new_content = copy.deepcopy(content) if content else empty_content()
+    new_content.setdefault("blocks", [])
+
+    # Fields and blocks are independent, so each kind is applied in order on its own
+    ops = copy.deepcopy(ops)
+    apply_ops(new_content["blocks"], ops)
+    apply_field_ops(new_content, [op for op in ops if op['op'] == FIELD_TEXT])
+    return new_content
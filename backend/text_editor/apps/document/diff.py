@@ -0,0 +1,277 @@
+import hashlib
+import json
+from .delta import INSERT, DELETE, REPLACE, TEXT, FIELD_TEXT
+
+
+EQUAL = 'equal'
+
+# Past this many edits a diff stops looking for the shortest script and
+# replaces the whole changed range instead
+MAX_BLOCK_EDITS = 50
+MAX_TEXT_EDITS = 32
+
+# Top-level string fields diffed as text instead of compared whole; the
+# editor keeps its plain text in 'content'
+TEXT_FIELDS = ('content',)
+
+# Keys are sorted so a block reloaded from a jsonb column hashes like the one sent by the client
+_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=str)
+
+
+def block_hash(block):
+    """Hash of the content of a block, equal for blocks with the same content"""
+    return hashlib.blake2b(_encoder.encode(block).encode('utf-8'), digest_size=16).digest()
+
+
+def block_hashes(blocks):
+    return [block_hash(block) for block in blocks]
+
+
+def rehash(hashes, ops, blocks):
+    """
+    Hashes of `blocks`, the result of applying ops to blocks with the given hashes.
+
+    Only the blocks touched by the ops are hashed again.
+    """
+    hashes = list(hashes)
+    for op in ops:
+        if op['op'] == INSERT:
+            hashes.insert(op['index'], None)
+        elif op['op'] == DELETE:
+            del hashes[op['index']]
+        elif op['op'] != FIELD_TEXT:
+            hashes[op['index']] = None
+    return [block_hash(blocks[index]) if value is None else value for index, value in enumerate(hashes)]
+
+
+def _common_affixes(a, b):
+    """Length of the common prefix and suffix of two sequences, not overlapping"""
+    limit = min(len(a), len(b))
+    prefix = 0
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    return prefix, suffix
+
+
+def edit_script(a, b, max_edits):
+    """
+    Shortest edit script turning sequence a into b (Myers' O(ND) algorithm).
+
+    Returns a list of EQUAL, DELETE and INSERT steps, or None when more than
+    max_edits insertions and deletions are needed.
+    """
+    n, m = len(a), len(b)
+    if abs(n - m) > max_edits:
+        return None
+
+    frontier = {1: 0}
+    trace = []
+    for edits in range(min(n + m, max_edits) + 1):
+        trace.append(frontier.copy())
+        for k in range(-edits, edits + 1, 2):
+            if k == -edits or (k != edits and frontier[k - 1] < frontier[k + 1]):
+                x = frontier[k + 1]
+            else:
+                x = frontier[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            frontier[k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return None
+
+
+def _backtrack(trace, x, y):
+    steps = []
+    for edits in range(len(trace) - 1, -1, -1):
+        frontier = trace[edits]
+        k = x - y
+        if k == -edits or (k != edits and frontier[k - 1] < frontier[k + 1]):
+            previous_k = k + 1
+        else:
+            previous_k = k - 1
+        previous_x = frontier[previous_k]
+        previous_y = previous_x - previous_k
+        while x > previous_x and y > previous_y:
+            steps.append(EQUAL)
+            x -= 1
+            y -= 1
+        if edits:
+            steps.append(INSERT if x == previous_x else DELETE)
+        x, y = previous_x, previous_y
+    steps.reverse()
+    return steps
+
+
+def _push(components, component):
+    """Append a text component, merging it with the previous one of the same kind"""
+    if components:
+        last = components[-1]
+        if isinstance(last, str) and isinstance(component, str):
+            components[-1] = last + component
+            return
+        if isinstance(last, int) and isinstance(component, int) and (last > 0) == (component > 0):
+            components[-1] = last + component
+            return
+    components.append(component)
+
+
+def diff_text(old, new):
+    """
+    Text components (see delta.validate_ops) turning string old into new,
+    without the trailing retain. Empty when the strings are equal.
+    """
+    prefix, suffix = _common_affixes(old, new)
+    old_middle = old[prefix:len(old) - suffix]
+    new_middle = new[prefix:len(new) - suffix]
+
+    components = []
+    if prefix and (old_middle or new_middle):
+        components.append(prefix)
+
+    steps = edit_script(old_middle, new_middle, MAX_TEXT_EDITS) if old_middle and new_middle else None
+    if steps is None:
+        if old_middle:
+            _push(components, -len(old_middle))
+        if new_middle:
+            _push(components, new_middle)
+        return components
+
+    new_position = 0
+    for step in steps:
+        if step == EQUAL:
+            _push(components, 1)
+            new_position += 1
+        elif step == DELETE:
+            _push(components, -1)
+        else:
+            _push(components, new_middle[new_position])
+            new_position += 1
+
+    if components and isinstance(components[-1], int) and components[-1] > 0:
+        components.pop()
+    return components
+
+
+def _only_text_changed(old_block, new_block):
+    """Whether two blocks differ only by their content string"""
+    if not isinstance(old_block, dict) or not isinstance(new_block, dict):
+        return False
+    if not isinstance(old_block.get('content'), str) or not isinstance(new_block.get('content'), str):
+        return False
+    if old_block.keys() != new_block.keys():
+        return False
+    return all(old_block[key] == new_block[key] for key in old_block if key != 'content')
+
+
+def _change_op(index, old_block, new_block):
+    if _only_text_changed(old_block, new_block):
+        return {'op': TEXT, 'index': index, 'ops': diff_text(old_block['content'], new_block['content'])}
+    return {'op': REPLACE, 'index': index, 'block': new_block}
+
+
+def diff_blocks(old_blocks, new_blocks, old_hashes=None):
+    """
+    Block operations turning old_blocks into new_blocks, and the hashes of new_blocks.
+
+    The unchanged blocks at both ends are skipped first, then the blocks in
+    between are aligned with the shortest edit script. When the blocks changed
+    too much for that, blocks are compared in place if their count is the same,
+    otherwise the whole range is replaced. A deleted block followed by an
+    inserted one becomes a replace, or a text operation when only its content
+    string changed.
+
+    Given the hashes of old_blocks, the hashes of new_blocks are derived from
+    them so only inserted and changed blocks are hashed; otherwise None is
+    returned in their place.
+    """
+    prefix, suffix = _common_affixes(old_blocks, new_blocks)
+    old_end = len(old_blocks) - suffix
+    new_end = len(new_blocks) - suffix
+    old_middle = old_blocks[prefix:old_end]
+    new_middle = new_blocks[prefix:new_end]
+
+    steps = edit_script(old_middle, new_middle, MAX_BLOCK_EDITS)
+    if steps is None and len(old_middle) == len(new_middle):
+        steps = []
+        for old_block, new_block in zip(old_middle, new_middle):
+            steps.extend((EQUAL,) if old_block == new_block else (DELETE, INSERT))
+    elif steps is None:
+        steps = [DELETE] * len(old_middle) + [INSERT] * len(new_middle)
+
+    ops = []
+    middle_hashes = []
+    index = prefix
+    old_position = new_position = prefix
+    deleted = []
+    inserted = []
+
+    def flush_changes():
+        nonlocal index
+        # Pair deletions with insertions at the same place as in-place changes
+        for old_block, new_block in zip(deleted, inserted):
+            if old_block != new_block:
+                ops.append(_change_op(index, old_block, new_block))
+            index += 1
+        for _ in deleted[len(inserted):]:
+            ops.append({'op': DELETE, 'index': index})
+        for new_block in inserted[len(deleted):]:
+            ops.append({'op': INSERT, 'index': index, 'block': new_block})
+            index += 1
+        deleted.clear()
+        inserted.clear()
+
+    for step in steps:
+        if step == EQUAL:
+            flush_changes()
+            if old_hashes is not None:
+                middle_hashes.append(old_hashes[old_position])
+            index += 1
+            old_position += 1
+            new_position += 1
+        elif step == DELETE:
+            deleted.append(old_blocks[old_position])
+            old_position += 1
+        else:
+            inserted.append(new_blocks[new_position])
+            if old_hashes is not None:
+                middle_hashes.append(block_hash(new_blocks[new_position]))
+            new_position += 1
+    flush_changes()
+
+    if old_hashes is None:
+        return ops, None
+    return ops, old_hashes[:prefix] + middle_hashes + old_hashes[old_end:]
+
+
+def diff_content(old_content, new_content, old_hashes=None):
+    """
+    Diff two document contents whose only differences are in their blocks and
+    their text fields.
+
+    Returns the operations and the hashes of the new blocks, or None when
+    other fields changed and the new content can't be expressed as a delta.
+    """
+    if not isinstance(old_content, dict) or not isinstance(old_content.get('blocks', []), list):
+        return None
+    if not isinstance(new_content, dict) or not isinstance(new_content.get('blocks'), list):
+        return None
+
+    texts = [
+        field for field in TEXT_FIELDS
+        if isinstance(old_content.get(field), str) and isinstance(new_content.get(field), str)
+    ]
+    if {key: value for key, value in old_content.items() if key != 'blocks' and key not in texts} != \
+            {key: value for key, value in new_content.items() if key != 'blocks' and key not in texts}:
+        return None
+
+    ops, hashes = diff_blocks(old_content.get('blocks', []), new_content['blocks'], old_hashes)
+    for field in texts:
+        if old_content[field] != new_content[field]:
+            ops.append({'op': FIELD_TEXT, 'field': field, 'ops': diff_text(old_content[field], new_content[field])})
+    return ops, hashes
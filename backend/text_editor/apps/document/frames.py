@@ -0,0 +1,21 @@
+import msgpack
+from text_editor.apps.core import codec
+
+
+# Subprotocol a client offers on connect to get documents as MessagePack binary frames
+MSGPACK_SUBPROTOCOL = 'textflow.msgpack'
+
+# Messages carrying a whole document, sent as binary frames to the sockets that negotiated it.
+# Smaller messages stay JSON text, they don't gain much and are shared with the rest of the room.
+BINARY_MESSAGES = ('INITIALIZE', 'UPDATE', 'UNDO', 'REDO', 'CONFLICT')
+
+
+def pack(message):
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def decode_frame(text_data=None, bytes_data=None):
+    """Decode a frame received from a client, JSON text or a MessagePack binary frame"""
+    if bytes_data is not None:
+        return msgpack.unpackb(bytes_data, raw=False)
+    return codec.loads(text_data)
@@ -0,0 +1,23 @@
+from collections import deque
+
+
+# How many edits of each user can be undone while the document is hot
+UNDO_LIMIT = 100
+
+
+class UndoHistory:
+    """
+    Undo and redo stacks of one user's edits on a hot document.
+
+    Entries are (version, ops): the ops undo (or redo) the edit committed at
+    that version and must be rebased over everything committed after it.
+    """
+
+    def __init__(self):
+        self.undo = deque(maxlen=UNDO_LIMIT)
+        self.redo = deque(maxlen=UNDO_LIMIT)
+
+    def record(self, version, inverse_ops):
+        """Remember how to undo a new edit, which drops what could be redone"""
+        self.undo.append((version, inverse_ops))
+        self.redo.clear()
@@ -0,0 +1,14 @@
+from rest_framework.pagination import CursorPagination
+
+
+class DocumentCursorPagination(CursorPagination):
+    """
+    Pages of documents, most recently updated first.
+
+    The cursor keeps each page an index range scan however many documents
+    come before it, where an offset would have the database skip them.
+    """
+    ordering = ('-updated_at', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
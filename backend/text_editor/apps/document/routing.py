@@ -1,7 +1,23 @@
+from django.conf import settings
 from django.urls import re_path
 from . import consumer
+from .auth import TokenAuthMiddleware
+from .viewers import SharedLinkRouter
+from .sharding import shard_channel
 
 websocket_urlpatterns = [
-    re_path(r'ws/document/(?P<document_id>\w+)/$', consumer.DocumentConsumer.as_asgi()),
-    re_path(r'ws/document/shared/(?P<shared_id>\w+)/$', consumer.GuestDocumentConsumer.as_asgi()),
-]
\ No newline at end of file
+    re_path(r'ws/document/(?P<document_id>\w+)/$', TokenAuthMiddleware(consumer.DocumentConsumer.as_asgi())),
+    # Read-only links go to the viewer tier
+    re_path(r'ws/document/shared/(?P<shared_id>\w+)/$', TokenAuthMiddleware(SharedLinkRouter(
+        consumer.GuestDocumentConsumer.as_asgi(),
+        consumer.DocumentViewerConsumer.as_asgi(),
+    ))),
+    # Always read-only, for proxies sending viewers to workers dedicated to them
+    re_path(r'ws/document/view/(?P<shared_id>\w+)/$', TokenAuthMiddleware(consumer.DocumentViewerConsumer.as_asgi())),
+]
+
+# Shard workers that own the hot state of documents, see settings.DOCUMENT_SHARDS
+channel_name_routes = {
+    shard_channel(shard): consumer.DocumentShardConsumer.as_asgi()
+    for shard in settings.DOCUMENT_SHARDS
+}
@@ -1,10 +1,11 @@
-from rest_framework.serializers import ModelSerializer, IntegerField, SerializerMethodField, ListField, ChoiceField
+from rest_framework.serializers import ModelSerializer, IntegerField, SerializerMethodField, ListField, ChoiceField, JSONField
 from text_editor.apps.core.models import Document, DocumentAccessToken
 from django.utils.timezone import now
 
 
 class DocumentSerializer(ModelSerializer):
     version = IntegerField(source='current_version', read_only=True)
+    content = JSONField(required=False, allow_null=True)
     last_updated = SerializerMethodField()  # Add a custom field for human-readable time
 
     class Meta:
@@ -17,6 +18,15 @@ class DocumentSerializer(ModelSerializer):
         time_difference = now() - obj.updated_at
         minutes_ago = int(time_difference.total_seconds() // 60)
         return f"{minutes_ago} min ago" if minutes_ago > 0 else "Just now"
+
+
+class DocumentSummarySerializer(DocumentSerializer):
+    """A document without its content, for the document lists"""
+
+    class Meta:
+        model = Document
+        fields = ['id', 'title', 'preview', 'updated_at', 'last_updated', 'version']
+        read_only_fields = fields
     
 
 class DocumentAccessSerializer(ModelSerializer):
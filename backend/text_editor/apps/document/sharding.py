@@ -0,0 +1,56 @@
+import bisect
+import hashlib
+from django.conf import settings
+
+
+SHARD_CHANNEL_PREFIX = 'document-shard-'
+
+
+def shard_channel(shard):
+    """Name of the channel a shard worker listens on"""
+    return f'{SHARD_CHANNEL_PREFIX}{shard}'
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping document ids to shards.
+
+    Each shard gets `replicas` points on the ring so documents spread evenly,
+    and adding or removing a shard only moves the documents next to its points.
+    """
+
+    def __init__(self, shards, replicas=100):
+        self.shards = list(shards)
+        self._ring = sorted(
+            (_hash(f'{shard}:{replica}'), shard)
+            for shard in self.shards
+            for replica in range(replicas)
+        )
+        self._keys = [key for key, shard in self._ring]
+
+    def owner(self, document_id):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._keys, _hash(str(document_id))) % len(self._ring)
+        return self._ring[index][1]
+
+
+_ring = None
+
+
+def owner_channel(document_id):
+    """
+    Channel of the shard worker that owns the document, or None when
+    sharding is disabled and every worker handles its own sockets.
+    """
+    global _ring
+    shards = getattr(settings, 'DOCUMENT_SHARDS', [])
+    if not shards:
+        return None
+    if _ring is None or _ring.shards != list(shards):
+        _ring = HashRing(shards)
+    return shard_channel(_ring.owner(document_id))
@@ -0,0 +1,495 @@
+import asyncio
+from collections import deque
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.timesince import timesince
+from django.utils.timezone import now
+from text_editor.apps.core.models import Document, OperationalLog, content_preview
+from .delta import apply_delta, empty_content, DeltaError
+from .diff import block_hashes, rehash
+from .blocks import split_snapshot, store_blocks
+from .history import UndoHistory
+from .viewers import ViewerPublisher
+
+
+# How many committed deltas each hot document keeps to rebase late clients
+RECENT_OPS_LIMIT = 200
+
+# Clients reconnecting further behind than this get the full document instead of the missed deltas
+CATCH_UP_LIMIT = 500
+
+# Flush windows to wait for another process to store the versions followed from it, before reloading
+FOLLOW_FLUSH_RETRIES = 10
+
+WRITE_BEHIND_DEFAULTS = {
+    'FLUSH_INTERVAL': 0.5,
+    'MAX_BATCH_SIZE': 50,
+    'DURABILITY': 'batched',
+}
+
+
+def snapshot_interval():
+    """Number of versions between two full snapshots in the operation log"""
+    return getattr(settings, 'OPERATIONAL_LOG_SNAPSHOT_INTERVAL', 50)
+
+
+def write_behind_setting(name):
+    """Read an option of settings.DOCUMENT_WRITE_BEHIND, falling back to the defaults"""
+    options = getattr(settings, 'DOCUMENT_WRITE_BEHIND', {})
+    return options.get(name, WRITE_BEHIND_DEFAULTS[name])
+
+
+class VersionConflict(Exception):
+    """The stored document is not at the version the pending operations were made against"""
+
+    def __init__(self, version):
+        super().__init__(f"Document is at version {version}")
+        self.version = version
+
+
+class DocumentState:
+    """
+    In-process state of a document that has at least one open socket.
+
+    Consumers read and mutate this instead of the database, through `sequence`
+    so operations apply in order; committed operations are queued and written
+    behind by `flush`.
+    """
+
+    def __init__(self, document_id, title, content, version, updated_at, last_snapshot_version=None):
+        self.document_id = document_id
+        self.title = title
+        self.content = content if content is not None else empty_content()
+        self.version = version
+        self.loaded_version = version
+        self.updated_at = updated_at
+        self.last_snapshot_version = last_snapshot_version
+        self._block_hashes = None
+        self.recent_ops = deque(maxlen=RECENT_OPS_LIMIT)
+        self.histories = {}
+        self.reverted = {}
+        self.connections = set()
+        self.binary_connections = set()
+        self.pending = []
+        self.registry = None
+        self.reloads = 0
+        self.followed_version = None
+        self.follow_retries = 0
+        self.viewers = ViewerPublisher(self)
+        # (version, content, updated_at), replaced at once after each change so
+        # code outside the event loop, like the REST views, reads them together
+        self.latest = (self.version, self.content, self.updated_at)
+        self._operations = asyncio.Queue()
+        self._sequencer = None
+        self._flush_lock = asyncio.Lock()
+        self._flush_now = asyncio.Event()
+        self._flush_task = None
+
+    @property
+    def block_hashes(self):
+        """Content hashes of the blocks, carried across commits so unchanged blocks are not hashed again"""
+        if self._block_hashes is None:
+            blocks = self.content.get('blocks', []) if isinstance(self.content, dict) else []
+            self._block_hashes = block_hashes(blocks if isinstance(blocks, list) else [])
+        return self._block_hashes
+
+    def history(self, key):
+        """Undo history of the edits made under `key`, created on first use"""
+        if key not in self.histories:
+            self.histories[key] = UndoHistory()
+        return self.histories[key]
+
+    def history_ops_since(self, base_version):
+        """
+        Like ops_since, but skipping the commits reverted by the undo or redo
+        right after them, and the pair itself.
+
+        Undo entries are rebased over these instead of all the ops, so a
+        block deleted and inserted back keeps the edits recorded for it.
+        """
+        if base_version < self.loaded_version:
+            return None
+
+        ops = []
+        reverted_until = base_version
+        for version, version_ops in self.recent_ops:
+            if version <= reverted_until:
+                continue
+            if version in self.reverted:
+                reverted_until = self.reverted[version]
+                continue
+            if version_ops is None:
+                return None
+            ops.extend(version_ops)
+
+        if self.recent_ops and self.recent_ops[0][0] > base_version + 1:
+            return None
+        return ops
+
+    def mark_reverted(self, version, reverted_by):
+        """Record that the commit at reverted_by restores the document to its state before `version`"""
+        self.reverted[version] = reverted_by
+        oldest = self.recent_ops[0][0] if self.recent_ops else reverted_by
+        for old_version in [key for key in self.reverted if key < oldest]:
+            del self.reverted[old_version]
+
+    def has_binary_sockets(self, exclude=None):
+        """Whether a socket of this process other than `exclude` reads MessagePack binary frames"""
+        return any(channel_name != exclude for channel_name in self.binary_connections)
+
+    def snapshot(self):
+        """Return the document in the shape sent to the clients"""
+        return {
+            'id': str(self.document_id),
+            'title': self.title,
+            'content': self.content,
+            'version': self.version,
+            'last_updated': timesince(self.updated_at, now()) + " ago",
+        }
+
+    def ops_since(self, base_version):
+        """
+        Return the delta operations committed after base_version, or None when
+        they are not all held in memory.
+        """
+        if base_version < self.loaded_version:
+            return None
+
+        ops = []
+        for version, version_ops in self.recent_ops:
+            if version <= base_version:
+                continue
+            if version_ops is None:
+                return None
+            ops.extend(version_ops)
+
+        if self.recent_ops and self.recent_ops[0][0] > base_version + 1:
+            return None
+        return ops
+
+    async def sequence(self, operation, *args):
+        """
+        Run `await operation(*args)` once every operation submitted before it is done.
+
+        A single task per document drains the queue, so reading the state,
+        committing and broadcasting a change can't interleave with another
+        socket's operation, and versions reach the room in order.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._operations.put_nowait((operation, args, future))
+        if self._sequencer is None or self._sequencer.done():
+            self._sequencer = asyncio.ensure_future(self._run_sequencer())
+        return await future
+
+    async def _run_sequencer(self):
+        """Apply the queued operations one by one, stopping once the queue is empty"""
+        while not self._operations.empty():
+            operation, args, future = self._operations.get_nowait()
+            if future.cancelled():
+                # The socket went away before its turn
+                continue
+            try:
+                result = await operation(*args)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    def commit(self, operation, content, position=None, operation_data=None, ops=None, block_hashes=None):
+        """
+        Make `content` the new version of the document and queue it for persistence.
+
+        `ops` are the delta operations that produced it, kept so later deltas
+        can be rebased without reading the log back. The log only stores the
+        full content when there are no ops or every OPERATIONAL_LOG_SNAPSHOT_INTERVAL
+        versions, as references to blocks stored once; other rows are rebuilt
+        from the previous snapshot.
+        `block_hashes` are the hashes of the new blocks when already known.
+        """
+        if block_hashes is None and ops and self._block_hashes is not None:
+            block_hashes = rehash(self._block_hashes, ops, content['blocks'])
+
+        self.version += 1
+        self.content = content
+        self.updated_at = now()
+        self._block_hashes = block_hashes
+        self.recent_ops.append((self.version, ops))
+        self.latest = (self.version, self.content, self.updated_at)
+        self.viewers.changed()
+
+        is_snapshot = (
+            ops is None
+            or self.last_snapshot_version is None
+            or self.version - self.last_snapshot_version >= snapshot_interval()
+        )
+        snapshot_fields, blocks = {}, {}
+        if is_snapshot:
+            self.last_snapshot_version = self.version
+            snapshot_fields, blocks = split_snapshot(content, self.block_hashes)
+
+        self.pending.append(({
+            'operation': operation,
+            'version': self.version,
+            'position': position,
+            'is_snapshot': is_snapshot,
+            'operation_data': operation_data,
+            **snapshot_fields,
+        }, content, blocks))
+        self.schedule_flush()
+        return self.version
+
+    def follow(self, document):
+        """
+        Apply the next version of the document, committed by another process
+        and broadcast to the room. Returns whether it was applied.
+
+        It isn't queued for persistence, the other process writes it. A version
+        committed here meanwhile ends in a version conflict, resolved by reloading.
+        """
+        if document.get('version') != self.version + 1:
+            return False
+
+        ops = document.get('ops')
+        block_hashes = None
+        if ops is not None:
+            try:
+                content = apply_delta(self.content, ops)
+            except DeltaError:
+                return False
+            if self._block_hashes is not None:
+                block_hashes = rehash(self._block_hashes, ops, content['blocks'])
+        elif 'content' in document:
+            content = document['content']
+        else:
+            return False
+
+        self.version += 1
+        self.content = content
+        self.updated_at = now()
+        self._block_hashes = block_hashes
+        self.recent_ops.append((self.version, ops))
+        self.latest = (self.version, self.content, self.updated_at)
+        self.followed_version = self.version
+        return True
+
+    def waits_for_followed(self, stored_version):
+        """Whether the stored document only misses versions followed from another process, not written yet"""
+        if self.followed_version is None or stored_version is None or stored_version >= self.followed_version:
+            return False
+        self.follow_retries += 1
+        return self.follow_retries <= FOLLOW_FLUSH_RETRIES
+
+    def schedule_flush(self):
+        """Start the write-behind task, or cut its window short once a batch is full"""
+        if len(self.pending) >= write_behind_setting('MAX_BATCH_SIZE'):
+            self._flush_now.set()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._write_behind())
+
+    async def _write_behind(self):
+        """Coalesce commits over the flush window and write them as one batch"""
+        while self.pending:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), write_behind_setting('FLUSH_INTERVAL'))
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            # On failure the entries are back in pending and retried next window
+            await self.flush()
+
+        if self.registry:
+            self.registry.evict_if_idle(self)
+
+    async def persisted(self):
+        """
+        Wait until the last commit is durable when DURABILITY is 'sync'.
+
+        With the default 'batched' durability commits are acknowledged as soon
+        as they are applied in memory and written within FLUSH_INTERVAL.
+        Returns False when the commit was dropped by a version conflict.
+        """
+        if write_behind_setting('DURABILITY') == 'sync':
+            reloads = self.reloads
+            await self.flush()
+            return self.reloads == reloads
+        return True
+
+    async def flush(self):
+        """Write the pending operations to the database in version order"""
+        async with self._flush_lock:
+            while self.pending:
+                entries, self.pending = self.pending, []
+                try:
+                    await persist_entries(self.document_id, entries)
+                    self.follow_retries = 0
+                except VersionConflict as e:
+                    if self.waits_for_followed(e.version):
+                        self.pending = entries + self.pending
+                        return False
+                    print(f"Version conflict on document {self.document_id}: {e}")
+                    await self.resolve_conflict()
+                    return False
+                except Exception as e:
+                    print(f"Error persisting document {self.document_id}: {e}")
+                    self.pending = entries + self.pending
+                    return False
+        return True
+
+    async def resolve_conflict(self):
+        """
+        Another process moved the stored document on: drop the pending
+        operations, reload the document and resync every socket of the room.
+        """
+        self.pending = []
+        stored = await load_state(self.document_id)
+        if stored is None:
+            return
+
+        self.title = stored.title
+        self.content = stored.content
+        self.version = self.loaded_version = stored.version
+        self.updated_at = stored.updated_at
+        self.latest = (self.version, self.content, self.updated_at)
+        self.last_snapshot_version = stored.last_snapshot_version
+        self._block_hashes = None
+        self.recent_ops.clear()
+        # The reloaded versions don't match the recorded edits anymore
+        self.histories.clear()
+        self.reverted.clear()
+        self.followed_version = None
+        self.follow_retries = 0
+        self.reloads += 1
+        self.viewers.reset()
+
+        await get_channel_layer().group_send(f'document_{self.document_id}', {
+            'type': 'document_reply',
+            'message': {
+                'type': 'CONFLICT',
+                'version': self.version,
+                'document': self.snapshot(),
+            },
+        })
+
+
+@database_sync_to_async
+def load_state(document_id):
+    try:
+        document = Document.objects.get(id=document_id)
+    except (Document.DoesNotExist, ValueError):
+        return None
+
+    last_snapshot_version = (
+        OperationalLog.objects.filter(document_id=document.id, is_snapshot=True)
+        .order_by('-version')
+        .values_list('version', flat=True)
+        .first()
+    )
+
+    return DocumentState(
+        document_id=document.id,
+        title=document.title,
+        content=document.content,
+        version=document.current_version,
+        updated_at=document.updated_at,
+        last_snapshot_version=last_snapshot_version,
+    )
+
+
+@database_sync_to_async
+def persist_entries(document_id, entries):
+    """
+    Move the document to the last entry and insert the operation logs in one query.
+
+    The document row is only updated if it is still at the version the entries
+    follow, so a concurrent writer raises VersionConflict instead of being overwritten.
+    """
+    expected_version = entries[0][0]['version'] - 1
+    last_log, last_content, _ = entries[-1]
+
+    fields = {'content': last_content}
+    try:
+        fields['preview'] = content_preview(last_content)
+    except Exception as e:
+        # The preview is only shown in the lists, the operations are written without it
+        print(f"Error building the preview of document {document_id}: {e}")
+
+    with transaction.atomic():
+        updated = Document.objects.filter(id=document_id, current_version=expected_version).update(
+            current_version=F('current_version') + len(entries),
+            updated_at=now(),
+            **fields,
+        )
+        if not updated:
+            raise VersionConflict(
+                Document.objects.filter(id=document_id).values_list('current_version', flat=True).first()
+            )
+
+        blocks = {}
+        for log, content, snapshot_blocks in entries:
+            blocks.update(snapshot_blocks)
+        store_blocks(document_id, blocks)
+
+        OperationalLog.objects.bulk_create(
+            [OperationalLog(document_id=document_id, **log) for log, content, snapshot_blocks in entries],
+            batch_size=write_behind_setting('MAX_BATCH_SIZE'),
+        )
+
+
+class DocumentStateRegistry:
+    """Hot document states of this process, keyed by document id"""
+
+    def __init__(self):
+        self._states = {}
+        self._load_lock = asyncio.Lock()
+
+    def get(self, document_id):
+        return self._states.get(str(document_id))
+
+    async def acquire(self, document_id, channel_name, binary_frames=False):
+        """Return the state of the document, loading it on the first connection"""
+        key = str(document_id)
+        async with self._load_lock:
+            state = self._states.get(key)
+            if state is None:
+                state = await load_state(document_id)
+                if state is None:
+                    return None
+                state.registry = self
+                self._states[key] = state
+                state.viewers.discover()
+            state.connections.add(channel_name)
+            if binary_frames:
+                state.binary_connections.add(channel_name)
+            return state
+
+    async def release(self, document_id, channel_name):
+        """Forget a connection and evict the state once its room is empty"""
+        key = str(document_id)
+        state = self._states.get(key)
+        if state is None:
+            return
+
+        state.connections.discard(channel_name)
+        state.binary_connections.discard(channel_name)
+        if state.connections:
+            return
+
+        # Flush on disconnect; if the database is down the state stays loaded
+        # and the write-behind task keeps retrying before evicting it
+        if await state.flush():
+            self.evict_if_idle(state)
+        else:
+            state.schedule_flush()
+
+    def evict_if_idle(self, state):
+        key = str(state.document_id)
+        if not state.connections and not state.pending and self._states.get(key) is state:
+            del self._states[key]
+
+
+document_states = DocumentStateRegistry()
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from unittest import SkipTest
+from django.conf import settings
+from django.db import connection
+from django.test import TransactionTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from text_editor.apps.core.models import CustomUser, Document
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+try:
+    from fakeredis import TcpFakeServer
+except ImportError:
+    TcpFakeServer = None
+
+
+# Seconds to wait for a worker to listen, and for a message or a flush
+STARTUP_TIMEOUT = 30
+RECEIVE_TIMEOUT = 5
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Worker exited with {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Worker not listening on port {port}')
+
+
+def redis_available(url):
+    try:
+        return redis.Redis.from_url(url, socket_connect_timeout=1).ping()
+    except redis.RedisError:
+        return False
+
+
+def insert(version, text):
+    return {
+        'type': 'DELTA',
+        'base_version': version,
+        'ops': [{'op': 'insert', 'index': 0, 'block': {'type': 'text', 'content': text}}],
+    }
+
+
+class MultiWorkerRoomTest(TransactionTestCase):
+    """
+    Sockets connected to two daphne workers edit the same document through the
+    Redis channel layer. Uses the Redis server at settings.REDIS_URL, or an
+    in-process fakeredis server; skipped when neither is available.
+    """
+    shards = ()
+
+    @classmethod
+    def setUpClass(cls):
+        if redis is None or websockets is None:
+            raise SkipTest('redis and websockets are needed to run several workers')
+        cls.redis_url = cls.start_redis()
+        # Keep away from the channels of a real deployment on the same server
+        cls.channel_prefix = f'test_{uuid.uuid4().hex}'
+        super().setUpClass()
+        cls.processes = []
+        try:
+            cls.ports = [cls.start_worker() for _ in range(2)]
+            for shard in cls.shards:
+                cls.start_process(['manage.py', 'runworker', f'document-shard-{shard}'])
+        except Exception:
+            cls.stop_processes()
+            super().tearDownClass()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stop_processes()
+        super().tearDownClass()
+
+    @classmethod
+    def start_redis(cls):
+        if redis_available(settings.REDIS_URL):
+            return settings.REDIS_URL
+        if TcpFakeServer is None:
+            raise SkipTest(f'No Redis server at {settings.REDIS_URL} and fakeredis is not installed')
+        port = free_port()
+        server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f'redis://127.0.0.1:{port}/0'
+
+    @classmethod
+    def worker_env(cls):
+        database = connection.settings_dict
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join(sys.path),
+            DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE,
+            CHANNEL_LAYER_BACKEND='redis',
+            REDIS_URL=cls.redis_url,
+            CHANNEL_LAYER_PREFIX=cls.channel_prefix,
+            DOCUMENT_SHARDS=','.join(cls.shards),
+        )
+        # The workers must use the test database
+        for name, key in (('PGDATABASE', 'NAME'), ('PGUSER', 'USER'), ('PGPASSWORD', 'PASSWORD'),
+                          ('PGHOST', 'HOST'), ('PGPORT', 'PORT')):
+            if database.get(key):
+                env[name] = str(database[key])
+        return env
+
+    @classmethod
+    def start_process(cls, args):
+        process = subprocess.Popen(
+            [sys.executable, *args],
+            cwd=settings.BASE_DIR,
+            env=cls.worker_env(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        cls.processes.append(process)
+        return process
+
+    @classmethod
+    def start_worker(cls):
+        port = free_port()
+        process = cls.start_process(['-m', 'daphne', '-p', str(port), 'text_editor.asgi:application'])
+        wait_for_port(port, process)
+        return port
+
+    @classmethod
+    def stop_processes(cls):
+        for process in getattr(cls, 'processes', []):
+            process.terminate()
+        for process in getattr(cls, 'processes', []):
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='writer@example.com', password='password')
+        self.document = Document.objects.create(
+            title='Shared', user=self.user, content={'blocks': [], 'type': 'text', 'content': ''}
+        )
+        self.token = str(AccessToken.for_user(self.user))
+
+    def connect(self, port):
+        return websockets.connect(f'ws://127.0.0.1:{port}/ws/document/{self.document.id}/?token={self.token}')
+
+    async def receive(self, websocket):
+        return json.loads(await asyncio.wait_for(websocket.recv(), RECEIVE_TIMEOUT))
+
+    async def edit_from_both_workers(self):
+        async with self.connect(self.ports[0]) as first, self.connect(self.ports[1]) as second:
+            version = (await self.receive(first))['document']['version']
+            self.assertEqual((await self.receive(second))['document']['version'], version)
+
+            await first.send(json.dumps(insert(version, 'from the first worker')))
+            self.assertEqual(await self.receive(first), {'type': 'ACK', 'version': version + 1})
+            delta = await self.receive(second)
+            self.assertEqual(delta['type'], 'DELTA')
+            self.assertEqual(delta['document']['version'], version + 1)
+
+            await second.send(json.dumps(insert(version + 1, 'from the second worker')))
+            self.assertEqual(await self.receive(second), {'type': 'ACK', 'version': version + 2})
+            delta = await self.receive(first)
+            self.assertEqual(delta['type'], 'DELTA')
+            self.assertEqual(delta['document']['version'], version + 2)
+        return version + 2
+
+    def test_sockets_on_different_workers_share_edits(self):
+        version = asyncio.run(self.edit_from_both_workers())
+
+        # Flushed when the sockets leave
+        deadline = time.monotonic() + RECEIVE_TIMEOUT
+        while time.monotonic() < deadline:
+            self.document.refresh_from_db()
+            if self.document.current_version == version:
+                break
+            time.sleep(0.2)
+        self.assertEqual(self.document.current_version, version)
+        self.assertEqual(
+            [block['content'] for block in self.document.content['blocks']],
+            ['from the second worker', 'from the first worker'],
+        )
+
+
+class ShardedRoomTest(MultiWorkerRoomTest):
+    """The same edits with the documents owned by shard workers"""
+    shards = ('a', 'b')
@@ -0,0 +1,79 @@
+import time
+import weakref
+from django.conf import settings
+
+
+RATE_LIMIT_DEFAULTS = {
+    'COALESCE_WINDOW': 0.1,
+    'CONNECTION_RATE': 10,
+    'CONNECTION_BURST': 20,
+    'ROOM_RATE': 50,
+    'ROOM_BURST': 100,
+}
+
+
+def rate_limit_setting(name):
+    """Read an option of settings.DOCUMENT_RATE_LIMITS, falling back to the defaults"""
+    options = getattr(settings, 'DOCUMENT_RATE_LIMITS', {})
+    return options.get(name, RATE_LIMIT_DEFAULTS[name])
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average and bursts of `burst`; a rate of 0 disables it"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait(self):
+        """Seconds until a token is available, 0 if one is available now"""
+        if self.rate <= 0:
+            return 0
+        current = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (current - self.updated) * self.rate)
+        self.updated = current
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+# Buckets of the rooms with a socket in this process, dropped with their last socket
+_room_buckets = weakref.WeakValueDictionary()
+
+
+def room_bucket(document_id):
+    key = str(document_id)
+    bucket = _room_buckets.get(key)
+    if bucket is None:
+        bucket = TokenBucket(rate_limit_setting('ROOM_RATE'), rate_limit_setting('ROOM_BURST'))
+        _room_buckets[key] = bucket
+    return bucket
+
+
+class OperationThrottle:
+    """
+    Rate limits of one socket: its own bucket and the bucket shared by its room.
+
+    When documents are sharded each worker limits the sockets it serves, so
+    the room limit applies per worker.
+    """
+
+    def __init__(self, document_id):
+        self.connection = TokenBucket(
+            rate_limit_setting('CONNECTION_RATE'),
+            rate_limit_setting('CONNECTION_BURST'),
+        )
+        self.room = room_bucket(document_id)
+
+    def take(self):
+        """Take a token from both buckets, or return how many seconds to wait for one"""
+        wait = max(self.connection.wait(), self.room.wait())
+        if wait:
+            return wait
+        self.connection.consume()
+        self.room.consume()
+        return 0
@@ -0,0 +1,208 @@
+from .delta import INSERT, DELETE, REPLACE, TEXT, FIELD_TEXT, apply_ops, apply_text_ops
+
+
+def _is_insert(component):
+    return isinstance(component, str)
+
+
+def _length(component):
+    return len(component) if isinstance(component, str) else abs(component)
+
+
+def _shorten(component, n):
+    """Drop the first n characters covered by a retain or delete component"""
+    if component > 0:
+        return component - n or None
+    return component + n or None
+
+
+def _push(components, component):
+    """Append a component, merging it with the previous one of the same kind"""
+    if components:
+        last = components[-1]
+        if isinstance(last, str) and isinstance(component, str):
+            components[-1] = last + component
+            return
+        if isinstance(last, int) and isinstance(component, int) and (last > 0) == (component > 0):
+            components[-1] = last + component
+            return
+    components.append(component)
+
+
+def transform_text(components, against, first=False):
+    """
+    Rebase text components so they apply after `against` on the same string.
+
+    Both lists describe edits of the same original string. When both insert
+    at the same place, `first` decides whose text ends up first.
+    """
+    result = []
+    a = list(components)
+    b = list(against)
+    op1 = a.pop(0) if a else None
+    op2 = b.pop(0) if b else None
+
+    while op1 is not None or op2 is not None:
+        if op1 is not None and _is_insert(op1) and (first or op2 is None or not _is_insert(op2)):
+            _push(result, op1)
+            op1 = a.pop(0) if a else None
+            continue
+        if op2 is not None and _is_insert(op2):
+            _push(result, len(op2))
+            op2 = b.pop(0) if b else None
+            continue
+
+        # Past the end of a list everything is implicitly retained
+        if op1 is None:
+            op1 = _length(op2)
+        if op2 is None:
+            op2 = _length(op1)
+
+        n = min(_length(op1), _length(op2))
+        if op1 > 0 and op2 > 0:
+            _push(result, n)
+        elif op1 < 0 and op2 > 0:
+            _push(result, -n)
+        # A delete in `against` already removed what op1 covers
+
+        op1 = _shorten(op1, n)
+        op2 = _shorten(op2, n)
+        if op1 is None:
+            op1 = a.pop(0) if a else None
+        if op2 is None:
+            op2 = b.pop(0) if b else None
+
+    # Trailing retains are implicit
+    while result and isinstance(result[-1], int) and result[-1] > 0:
+        result.pop()
+    return result
+
+
+def transform_op(op, against, first=False):
+    """
+    Rebase a single operation so it applies after `against`.
+
+    Returns the rebased operation, or None when `against` made it obsolete
+    (e.g. editing a block that was deleted concurrently).
+    """
+    op = dict(op)
+    kind, other_kind = op['op'], against['op']
+
+    if kind == FIELD_TEXT or other_kind == FIELD_TEXT:
+        # Fields of the document are edited independently of its blocks
+        if kind == other_kind and op['field'] == against['field']:
+            components = transform_text(op['ops'], against['ops'], first)
+            if not components:
+                return None
+            op['ops'] = components
+        return op
+
+    index, other = op['index'], against['index']
+
+    if other_kind == INSERT:
+        if index > other or (index == other and (kind != INSERT or not first)):
+            op['index'] = index + 1
+        return op
+
+    if other_kind == DELETE:
+        if kind == INSERT:
+            if index > other:
+                op['index'] = index - 1
+            return op
+        if index == other:
+            return None
+        if index > other:
+            op['index'] = index - 1
+        return op
+
+    if index != other or kind in (INSERT, DELETE):
+        return op
+
+    if other_kind == REPLACE:
+        # The whole block was overwritten, so positions inside it are meaningless.
+        # Between two replaces the one applied last wins.
+        if kind == TEXT or first:
+            return None
+        return op
+
+    if other_kind == TEXT and kind == TEXT:
+        components = transform_text(op['ops'], against['ops'], first)
+        if not components:
+            return None
+        op['ops'] = components
+    return op
+
+
+def transform_ops(ops, against_ops):
+    """
+    Rebase a list of operations over operations that were applied before them.
+
+    `ops` and `against_ops` were both made against the same document version;
+    the result can be applied after `against_ops`.
+    """
+    ops = list(ops)
+    for against in against_ops:
+        rebased = []
+        for op in ops:
+            if against is None:
+                rebased.append(op)
+                continue
+            new_op = transform_op(op, against, first=False)
+            against = transform_op(against, op, first=True)
+            if new_op is not None:
+                rebased.append(new_op)
+        ops = rebased
+    return ops
+
+
+def invert_text(text, components):
+    """Text components undoing `components` once applied to the string text"""
+    result = []
+    cursor = 0
+    for component in components:
+        if _is_insert(component):
+            _push(result, -len(component))
+        elif component > 0:
+            _push(result, component)
+            cursor += component
+        else:
+            _push(result, text[cursor:cursor - component])
+            cursor -= component
+
+    while result and isinstance(result[-1], int) and result[-1] > 0:
+        result.pop()
+    return result
+
+
+def invert_ops(content, ops):
+    """
+    Operations undoing `ops` once applied to the document content (left untouched).
+
+    The ops must apply to the content, e.g. because they were just committed.
+    """
+    blocks = list(content.get('blocks', []))
+    fields = {}
+    inverse = []
+    for op in ops:
+        if op['op'] == FIELD_TEXT:
+            field = op['field']
+            text = fields[field] if field in fields else content.get(field) or ''
+            components = invert_text(text, op['ops'])
+            if components:
+                inverse.append({'op': FIELD_TEXT, 'field': field, 'ops': components})
+            fields[field] = apply_text_ops(text, op['ops'])
+            continue
+        index = op['index']
+        if op['op'] == INSERT:
+            inverse.append({'op': DELETE, 'index': index})
+        elif op['op'] == DELETE:
+            inverse.append({'op': INSERT, 'index': index, 'block': blocks[index]})
+        elif op['op'] == REPLACE:
+            inverse.append({'op': REPLACE, 'index': index, 'block': blocks[index]})
+        else:
+            components = invert_text(blocks[index].get('content') or '', op['ops'])
+            if components:
+                inverse.append({'op': TEXT, 'index': index, 'ops': components})
+        apply_ops(blocks, [op])
+    inverse.reverse()
+    return inverse
@@ -1,7 +1,8 @@
 from django.urls import path
-from .views import DocumentView, DocumentAccessTokenView
+from .views import DocumentView, DocumentDetailView, DocumentAccessTokenView
 
 urlpatterns = [
     path("documents/", DocumentView.as_view(), name="document-list-create"),
+    path("documents/<int:document_id>/", DocumentDetailView.as_view(), name="document-retrieve"),
     path("documents/shared/<int:document_id>/", DocumentAccessTokenView.as_view(), name="document-detail"),
 ]
\ No newline at end of file
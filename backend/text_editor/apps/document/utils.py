@@ -1,37 +1,31 @@
 from channels.db import database_sync_to_async
 from text_editor.apps.core.models import OperationalLog
-import json
-import copy
+from .delta import apply_delta, DeltaError
+from .blocks import expand_snapshot
 
 
-def get_position_of_change(document_id, new_content):
+def get_position_of_change(old_content, new_content):
     """
     Get the position of changes between old and new content.
     
     Args:
+        old_content (dict): The current JSON content of the document
         new_content (dict): The updated JSON content
-        document_id (int): The ID of the document being updated
         
     Returns:
-        tuple: (position, operation_type, changed_content, version)
+        tuple: (position, operation_type, changed_content)
             - position (int): The position of the first change
             - operation_type (str): 'insert' or 'delete'
             - changed_content (dict): The content that was inserted or deleted
-            - version (int): The version number
     """
     
-    print("new_content", new_content)
-    last_log = OperationalLog.objects.filter(document_id=document_id).order_by('-version').first()
-    if not last_log:
-        return 0, 'insert', new_content, 1  # The First log return the first position with all content as new
-
-    old_content = last_log.updated_content
-    
     # Handle special cases for empty content
     if not old_content and new_content:
-        return 0, 'insert', new_content, last_log.version + 1
+        return 0, 'insert', new_content
     elif old_content and not new_content:
-        return 0, 'delete', old_content, last_log.version + 1
+        return 0, 'delete', old_content
+    elif not old_content and not new_content:
+        return 0, 'insert', new_content
     
     # For JSON content, we need to compare blocks differently
     # Get blocks from old and new content
@@ -41,10 +35,10 @@ def get_position_of_change(document_id, new_content):
     # Handle cases where blocks are different lengths
     if not old_blocks and new_blocks:
         # New blocks added to empty content
-        return 0, 'insert', new_content, last_log.version + 1
+        return 0, 'insert', new_content
     elif old_blocks and not new_blocks:
         # All blocks deleted
-        return 0, 'delete', old_content, last_log.version + 1
+        return 0, 'delete', old_content
     
     # Compare blocks to find what changed
     min_blocks = min(len(old_blocks), len(new_blocks))
@@ -91,13 +85,87 @@ def get_position_of_change(document_id, new_content):
         
         changed_content = new_content
     
-    return position, operation_type, changed_content, last_log.version 
+    return position, operation_type, changed_content
+
+
+def get_ops_since(document_id, base_version, current_version):
+    """
+    Collect the delta operations committed after base_version, in order.
+
+    Returns None when one of those versions was not saved as a delta (e.g. a
+    full-content UPDATE or an undo), since there is nothing to rebase over.
+    """
+    logs = list(
+        OperationalLog.objects.filter(
+            document_id=document_id,
+            version__gt=base_version,
+            version__lte=current_version,
+        ).order_by('version').values('version', 'operation', 'operation_data')
+    )
+
+    if len(logs) != current_version - base_version:
+        return None
+
+    ops = []
+    for log in logs:
+        if log['operation'] != 'delta' or not log['operation_data']:
+            return None
+        ops.extend(log['operation_data'].get('ops', []))
+    return ops
+
+
+def reconstruct_version(document_id, version, known_blocks=None):
+    """
+    Rebuild the content of a document at a given version.
+
+    Starts from the nearest snapshot at or before the version and replays the
+    deltas logged after it. Only the snapshot blocks missing from known_blocks
+    (hash -> block) are read from the block store. Returns None when the
+    version is not in the log.
+    """
+    snapshot = (
+        OperationalLog.objects.filter(document_id=document_id, version__lte=version, is_snapshot=True)
+        .order_by('-version')
+        .values('version', 'updated_content', 'block_refs')
+        .first()
+    )
+    if not snapshot:
+        return None
+
+    content = expand_snapshot(document_id, snapshot['updated_content'], snapshot['block_refs'], known_blocks)
+    if content is None or snapshot['version'] == version:
+        return content
+
+    logs = list(
+        OperationalLog.objects.filter(
+            document_id=document_id,
+            version__gt=snapshot['version'],
+            version__lte=version,
+        ).order_by('version').values_list('operation_data', flat=True)
+    )
+    if len(logs) != version - snapshot['version']:
+        return None
+
+    ops = []
+    for operation_data in logs:
+        if not operation_data or not operation_data.get('ops'):
+            return None
+        ops.extend(operation_data['ops'])
+
+    try:
+        return apply_delta(content, ops)
+    except DeltaError as e:
+        print(f"Error rebuilding version {version} of document {document_id}: {e}")
+        return None
 
 
-# New async-compatible function
 @database_sync_to_async
-def get_position_of_change_async(document_id, new_content):
-    """Async wrapper for get_position_of_change function"""
-    return get_position_of_change(document_id, new_content)
+def get_ops_since_async(document_id, base_version, current_version):
+    """Async wrapper for get_ops_since function"""
+    return get_ops_since(document_id, base_version, current_version)
 
 
+@database_sync_to_async
+def reconstruct_version_async(document_id, version, known_blocks=None):
+    """Async wrapper for reconstruct_version function"""
+    return reconstruct_version(document_id, version, known_blocks)
@@ -0,0 +1,184 @@
+import asyncio
+import time
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils.timesince import timesince
+from django.utils.timezone import now
+from text_editor.apps.core import codec
+from text_editor.apps.core.models import Document
+from .frames import BINARY_MESSAGES, pack
+
+
+VIEWER_DEFAULTS = {
+    'RATE': 2,
+}
+
+
+def viewer_setting(name):
+    """Read an option of settings.DOCUMENT_VIEWERS, falling back to the defaults"""
+    options = getattr(settings, 'DOCUMENT_VIEWERS', {})
+    return options.get(name, VIEWER_DEFAULTS[name])
+
+
+def viewer_group(document_id):
+    """Group of the read-only viewers of a document, apart from the room of its writers"""
+    return f'document_{document_id}_viewers'
+
+
+def encode(message, binary_frames):
+    """Frames of a message encoded once for the whole viewer group, MessagePack too when a viewer reads binary frames"""
+    frames = {'text': codec.dumps(message)}
+    if binary_frames and message['type'] in BINARY_MESSAGES:
+        frames['bytes'] = pack(message)
+    return frames
+
+
+@database_sync_to_async
+def read_document(document_id):
+    """The stored document in the shape of DocumentState.snapshot, without loading a hot state"""
+    document = (
+        Document.objects.filter(id=document_id)
+        .values('id', 'title', 'content', 'current_version', 'updated_at')
+        .first()
+    )
+    if document is None:
+        return None
+    return {
+        'id': str(document['id']),
+        'title': document['title'],
+        'content': document['content'],
+        'version': document['current_version'],
+        'last_updated': timesince(document['updated_at'], now()) + " ago",
+    }
+
+
+class ViewerPublisher:
+    """
+    Publishes the changes of a hot document to its viewer group.
+
+    Commits only mark the document as changed; at most RATE times per second
+    the ops committed since the last publish are sent as one DELTA, encoded
+    once for every viewer. A keyframe with the whole document is added when
+    those ops are no longer in memory or a viewer out of sync asks for one.
+
+    Nothing is published while no viewer is attached. Viewer sockets announce
+    themselves with document.viewer messages, and are asked to again when the
+    state is loaded, in case they connected before it.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.version = state.version
+        self.keyframe = False
+        self.reset_viewers = False
+        self.published_at = 0
+        # Channel names of the viewers, mapped to whether they read binary frames
+        self.channels = {}
+        self._task = None
+
+    def changed(self):
+        if not self.channels:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._publish_changes())
+
+    def handle(self, event):
+        """A viewer socket joined, left, or is out of sync"""
+        channel_name = event['viewer_channel']
+        action = event['action']
+        if action == 'leave':
+            self.channels.pop(channel_name, None)
+            return
+
+        first = not self.channels
+        self.channels[channel_name] = event.get('binary_frames', False)
+        if first:
+            # The changes made while nobody was watching are not published, the keyframe has them
+            self.version = self.state.version
+        if first or action == 'sync':
+            self.request_keyframe()
+
+    def discover(self):
+        """Ask the viewers already connected to announce themselves"""
+        return asyncio.ensure_future(self._discover())
+
+    async def _discover(self):
+        try:
+            await get_channel_layer().group_send(viewer_group(self.state.document_id), {'type': 'viewer_announce'})
+        except Exception as e:
+            print(f"Error discovering the viewers of document {self.state.document_id}: {e}")
+
+    def request_keyframe(self):
+        self.keyframe = True
+        self.changed()
+
+    def reset(self):
+        """The document was reloaded: send it whole, replacing the versions viewers already have"""
+        self.version = self.state.version
+        self.reset_viewers = True
+        self.request_keyframe()
+
+    async def _publish_changes(self):
+        """Publish until the viewers are up to date, waiting 1 / RATE seconds between publishes"""
+        rate = viewer_setting('RATE')
+        while self.channels and (self.keyframe or self.version != self.state.version):
+            if rate > 0:
+                wait = self.published_at + 1 / rate - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self.published_at = time.monotonic()
+            try:
+                await self.publish()
+            except Exception as e:
+                print(f"Error publishing document {self.state.document_id} to viewers: {e}")
+                return
+
+    async def publish(self):
+        state = self.state
+        document_id = str(state.document_id)
+        event = {
+            'type': 'viewer_update',
+            'base_version': self.version,
+            'version': state.version,
+        }
+
+        binary_frames = any(self.channels.values())
+        ops = state.ops_since(self.version) if state.version > self.version else None
+        if ops is not None:
+            event['delta'] = encode({
+                'type': 'DELTA',
+                'document': {
+                    'id': document_id,
+                    'base_version': self.version,
+                    'version': state.version,
+                    'ops': ops,
+                },
+            }, binary_frames)
+        if ops is None or self.keyframe:
+            event['snapshot'] = encode({
+                'type': 'UPDATE',
+                'document': {
+                    'id': document_id,
+                    'content': state.content,
+                    'version': state.version,
+                },
+            }, binary_frames)
+            event['reset'] = self.reset_viewers
+
+        self.version = state.version
+        self.keyframe = self.reset_viewers = False
+        await get_channel_layer().group_send(viewer_group(document_id), event)
+
+
+class SharedLinkRouter:
+    """Sends the sockets of read-only shared links to the viewer tier, and the others to `editor`"""
+
+    def __init__(self, editor, viewer):
+        self.editor = editor
+        self.viewer = viewer
+
+    async def __call__(self, scope, receive, send):
+        link = scope.get('shared_link')
+        application = self.viewer if link and 'write' not in link[2] else self.editor
+        return await application(scope, receive, send)
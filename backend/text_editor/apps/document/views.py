@@ -1,16 +1,27 @@
-from rest_framework.generics import ListCreateAPIView, DestroyAPIView, GenericAPIView
+from rest_framework.generics import ListCreateAPIView, DestroyAPIView, GenericAPIView, get_object_or_404
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags
+from django.utils.timezone import is_naive, make_aware
+from text_editor.apps.core import codec
 from text_editor.apps.core.models import Document, DocumentAccessToken
-from .serializers import DocumentSerializer, DocumentAccessSerializer
+from .pagination import DocumentCursorPagination
+from .serializers import DocumentSerializer, DocumentSummarySerializer, DocumentAccessSerializer
+from .state import document_states
+from .utils import reconstruct_version
 from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from uuid import uuid4
+import hashlib
 
 class DocumentView(ListCreateAPIView, DestroyAPIView):
     """
     API endpoint that allows documents to be:
-    - Listed (GET)
+    - Listed (GET), as pages of summaries; `?include=content` adds the content
+      and `updated_after`/`updated_before` filter on the last update
     - Created (POST)
     - Deleted (DELETE)
     """
@@ -18,6 +29,34 @@ class DocumentView(ListCreateAPIView, DestroyAPIView):
     queryset = Document.objects.all()
     permission_classes = [IsAuthenticated]
     authentication_classes = [JWTAuthentication]
+    pagination_class = DocumentCursorPagination
+
+    # Columns read for summaries, the content is never loaded
+    summary_fields = ('id', 'title', 'preview', 'updated_at', 'current_version')
+
+    def include_content(self):
+        return self.request.query_params.get('include') == 'content'
+
+    def get_serializer_class(self):
+        if self.request.method == 'GET' and not self.include_content():
+            return DocumentSummarySerializer
+        return super().get_serializer_class()
+
+    def filter_queryset(self, queryset):
+        for param, lookup in (('updated_after', 'updated_at__gt'), ('updated_before', 'updated_at__lt')):
+            value = self.request.query_params.get(param)
+            if not value:
+                continue
+            try:
+                timestamp = parse_datetime(value)
+            except ValueError:
+                timestamp = None
+            if timestamp is None:
+                raise ValidationError({param: 'Enter a valid ISO 8601 date and time.'})
+            if is_naive(timestamp):
+                timestamp = make_aware(timestamp)
+            queryset = queryset.filter(**{lookup: timestamp})
+        return super().filter_queryset(queryset)
 
     def create(self, request, *args, **kwargs):
         """
@@ -53,10 +92,14 @@ class DocumentView(ListCreateAPIView, DestroyAPIView):
         Handle listing of documents
         """
         queryset = self.filter_queryset(self.get_queryset().filter(user=request.user))
-        serializer = self.get_serializer(queryset, many=True)
+        if not self.include_content():
+            queryset = queryset.only(*self.summary_fields)
+
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
         
         # Return standard list response - no need to match WebSocket format for lists
-        return Response(serializer.data)
+        return self.get_paginated_response(serializer.data)
 
     def destroy(self, request, *args, **kwargs):
         """
@@ -68,7 +111,82 @@ class DocumentView(ListCreateAPIView, DestroyAPIView):
             {"detail": "Document deleted successfully."},
             status=status.HTTP_204_NO_CONTENT
         )
-    
+
+
+def content_digest(content):
+    """Short hash of a document's content, for the ETag of a version that isn't stored yet"""
+    return hashlib.blake2b(codec.dumps_bytes(content), digest_size=8).hexdigest()
+
+
+class DocumentDetailView(GenericAPIView):
+    """
+    API endpoint to fetch one document, at its current version or at
+    `?version=N` rebuilt from the operational log.
+
+    The ETag names the document and version, so a client sending it back in
+    If-None-Match gets a 304 without the content being loaded. Commits are
+    written behind: when this process holds the document's hot state, its
+    latest version is served. The hot state of another process isn't seen,
+    the stored version can then lag by up to the write-behind FLUSH_INTERVAL.
+    A hot version not written yet can still be replaced by another worker's
+    after a version conflict, so its ETag also carries a hash of the content.
+    """
+    serializer_class = DocumentSerializer
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+
+    def get(self, request, document_id):
+        document = get_object_or_404(Document.objects.defer('content'), id=document_id, user=request.user)
+        state = document_states.get(document.id)
+        latest = state.latest if state is not None and state.latest[0] >= document.current_version else None
+        current_version = latest[0] if latest else document.current_version
+
+        version = request.query_params.get('version')
+        if version is None:
+            version = current_version
+        else:
+            try:
+                version = int(version)
+            except ValueError:
+                raise ValidationError({'version': 'A valid integer is required.'})
+            if not 1 <= version <= current_version:
+                return Response({"detail": "Version not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        historical = version < current_version
+        if latest and not historical and version > document.current_version:
+            etag = f'"{document.id}-{version}-{content_digest(latest[1])}"'
+        else:
+            etag = f'"{document.id}-{version}"'
+        # Weak comparison, an ETag weakened by a proxy still matches
+        if_none_match = [tag.removeprefix('W/') for tag in parse_etags(request.headers.get('If-None-Match', ''))]
+        if etag in if_none_match or '*' in if_none_match:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            return self.cacheable(response, etag, historical)
+
+        if historical:
+            content = reconstruct_version(document.id, version)
+            if content is None:
+                return Response({"detail": "Version not found."}, status=status.HTTP_404_NOT_FOUND)
+            # Serialize the old version in place of the current one, the instance isn't saved
+            document.content = content
+            document.current_version = version
+        elif latest:
+            document.current_version, document.content, document.updated_at = latest
+
+        response = Response(self.get_serializer(document).data)
+        return self.cacheable(response, etag, historical)
+
+    def cacheable(self, response, etag, historical):
+        """Add the validators; past versions never change while the current one must be revalidated"""
+        response['ETag'] = etag
+        if historical:
+            patch_cache_control(response, private=True, max_age=365 * 24 * 60 * 60, immutable=True)
+        else:
+            patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization'])
+        return response
+
+
 class DocumentAccessTokenView(GenericAPIView):
     """
     API endpoint to create and retrieve the access token for a specific document.
@@ -1,19 +1,21 @@
 import os
 
-from channels.auth import AuthMiddlewareStack
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
-from text_editor.apps.document.routing import websocket_urlpatterns
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'text_editor.settings')
 
+# Set up Django before importing the consumers, so worker processes started
+# with `daphne text_editor.asgi:application` can load the models
 django_asgi_app = get_asgi_application()
 
+from text_editor.apps.document.routing import channel_name_routes, websocket_urlpatterns  # noqa: E402
+
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": AuthMiddlewareStack(
-        URLRouter(
-            websocket_urlpatterns
-        )
+    # Sockets are authenticated by TokenAuthMiddleware in the routes
+    "websocket": URLRouter(
+        websocket_urlpatterns
     ),
-})
\ No newline at end of file
+    "channel": ChannelNameRouter(channel_name_routes),
+})
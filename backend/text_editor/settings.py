@@ -163,17 +163,104 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Add Channel Layers for WebSocket communication
+# CHANNEL_LAYER_BACKEND selects how rooms are shared between processes:
+#   "memory"       - single process only (default)
+#   "redis"        - Redis channel layer, rooms span every worker and node
+#   "redis-pubsub" - Redis pub/sub channel layer, lower latency for group sends
+CHANNEL_LAYER_BACKENDS = {
+    "memory": "channels.layers.InMemoryChannelLayer",
+    "redis": "channels_redis.core.RedisChannelLayer",
+    "redis-pubsub": "channels_redis.pubsub.RedisPubSubChannelLayer",
+}
+CHANNEL_LAYER_BACKEND = os.environ.get("CHANNEL_LAYER_BACKEND", "memory")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+        "BACKEND": CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER_BACKEND],
     }
 }
+if CHANNEL_LAYER_BACKEND != "memory":
+    CHANNEL_LAYERS["default"]["CONFIG"] = {
+        "hosts": [REDIS_URL],
+        "prefix": os.environ.get("CHANNEL_LAYER_PREFIX", "text_editor"),
+    }
+
+# Write-behind persistence of document operations: commits are coalesced for
+# FLUSH_INTERVAL seconds (or until MAX_BATCH_SIZE is reached) and written in one
+# transaction. Set DURABILITY to 'sync' to persist every operation before it is broadcast.
+DOCUMENT_WRITE_BEHIND = {
+    'FLUSH_INTERVAL': float(os.environ.get('DOCUMENT_FLUSH_INTERVAL', 0.5)),
+    'MAX_BATCH_SIZE': int(os.environ.get('DOCUMENT_FLUSH_BATCH_SIZE', 50)),
+    'DURABILITY': os.environ.get('DOCUMENT_DURABILITY', 'batched'),
+}
+
+# Per-socket input shaping: UPDATEs received within COALESCE_WINDOW seconds are
+# merged into one, and each socket and each room is limited to RATE operations per
+# second with bursts of BURST (0 disables a limit).
+DOCUMENT_RATE_LIMITS = {
+    'COALESCE_WINDOW': float(os.environ.get('DOCUMENT_COALESCE_WINDOW', 0.1)),
+    'CONNECTION_RATE': float(os.environ.get('DOCUMENT_CONNECTION_RATE', 10)),
+    'CONNECTION_BURST': int(os.environ.get('DOCUMENT_CONNECTION_BURST', 20)),
+    'ROOM_RATE': float(os.environ.get('DOCUMENT_ROOM_RATE', 50)),
+    'ROOM_BURST': int(os.environ.get('DOCUMENT_ROOM_BURST', 100)),
+}
+
+# Sockets are authenticated from their token by TokenAuthMiddleware, which keeps
+# users and document access decisions for TTL seconds (0 disables the caches).
+# They are dropped when the user or document is saved in the same process.
+# Shared links are kept only SHARED_LINK_TTL seconds, so a link revoked through
+# another worker stops opening sockets here soon after.
+WEBSOCKET_AUTH_CACHE = {
+    'TTL': float(os.environ.get('WEBSOCKET_AUTH_CACHE_TTL', 60)),
+    'SHARED_LINK_TTL': float(os.environ.get('WEBSOCKET_SHARED_LINK_CACHE_TTL', 5)),
+    'MAX_SIZE': int(os.environ.get('WEBSOCKET_AUTH_CACHE_SIZE', 10000)),
+}
+
+# Readers of shared links are served by a separate viewer tier: the changes of a
+# document are published to them as one coalesced delta at most RATE times per
+# second (0 publishes every commit).
+DOCUMENT_VIEWERS = {
+    'RATE': float(os.environ.get('DOCUMENT_VIEWER_RATE', 2)),
+}
+
+# The operation log stores deltas and a full snapshot every N versions
+OPERATIONAL_LOG_SNAPSHOT_INTERVAL = int(os.environ.get('OPERATIONAL_LOG_SNAPSHOT_INTERVAL', 50))
+
+# Document content and log snapshots are stored as compressed JSON. CODEC is
+# 'zlib', 'zstd' (needs the zstandard package) or 'none'; values under MIN_SIZE
+# bytes are stored uncompressed. The content is written on every flush, so the
+# default LEVEL favours speed. Rows written with another codec stay readable.
+CONTENT_COMPRESSION = {
+    'CODEC': os.environ.get('CONTENT_COMPRESSION_CODEC', 'zlib'),
+    'LEVEL': int(os.environ.get('CONTENT_COMPRESSION_LEVEL', 1)),
+    'MIN_SIZE': int(os.environ.get('CONTENT_COMPRESSION_MIN_SIZE', 512)),
+}
+
+# JSON library used for socket frames, API responses and stored content: 'auto'
+# picks orjson when it is installed and the standard library otherwise.
+JSON_CODEC = os.environ.get('JSON_CODEC', 'auto')
+
+# Comma separated shard names. When set, each document is owned by one shard
+# worker (picked by consistent hashing) that applies all of its operations, and
+# socket workers only forward them. Needs a Redis channel layer; start one
+# worker per shard with `python manage.py runworker document-shard-<name>`.
+DOCUMENT_SHARDS = [shard for shard in os.environ.get('DOCUMENT_SHARDS', '').split(',') if shard]
 
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'text_editor.apps.core.renderers.CodecJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'text_editor.apps.core.renderers.CodecJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
 
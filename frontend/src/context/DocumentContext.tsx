@@ -4,10 +4,17 @@ import {
   useState,
   useEffect,
   useCallback,
+  useRef,
 } from "react";
 import { getDocuments } from "../services/apis/documentApi";
 import { websocketService } from "../services/websocket";
 import { DocumentState, Image } from "../types/index";
+import {
+  applyDelta,
+  diffContent,
+  transformOps,
+  DeltaOp,
+} from "../utils/deltaUtils";
 
 interface DocumentContextType {
   documents: DocumentState[];
@@ -34,6 +41,22 @@ interface DocumentContextType {
   removeImage: (imageId: string) => void;
 }
 
+// What the server has of the current document, and our edits on top of it
+interface SyncState {
+  version: number; // Last version committed by the server that we applied
+  content: any; // The content at that version
+  inflight: DeltaOp[] | null; // Sent against that version, not acknowledged yet
+  acked: number | null; // Version the server acknowledged them at, until the changes before it reach us
+  buffer: DeltaOp[]; // Made after them and not sent yet, one per edit
+  local: any; // The content shown, with every edit applied
+}
+
+// Whether every change committed before our acknowledged delta was received.
+// A delta rebased to nothing is acknowledged with the version of the last one.
+const caughtUp = (state: SyncState) =>
+  state.acked !== null &&
+  state.version >= (state.inflight?.length ? state.acked - 1 : state.acked);
+
 export const DocumentContext = createContext<DocumentContextType | undefined>(
   undefined
 );
@@ -55,6 +78,38 @@ export const DocumentProvider = ({ children }: DocumentProviderProps) => {
   const [wsConnected, setWsConnected] = useState(false);
   const [isGuest, setIsGuest] = useState(false);
   const [canEdit, setCanEdit] = useState(false);
+  const sync = useRef<SyncState>({
+    version: 0,
+    content: "",
+    inflight: null,
+    acked: null,
+    buffer: [],
+    local: "",
+  });
+  // Resends a delta the server rejected over its rate limits
+  const retryTimer = useRef<ReturnType<typeof setTimeout> | null>(null);
+
+  // Send our edits as a delta against the last version we have. Only one is
+  // in flight at a time: the next one is made from the version acknowledged
+  // for it, with whatever was typed in between. The ops of each edit are sent
+  // as they are, since a diff of the whole text would turn edits at different
+  // places into one replacing everything between them.
+  const sendPending = useCallback((documentId: string) => {
+    const state = sync.current;
+    if (state.inflight || retryTimer.current) return;
+    if (websocketService.status !== WebSocket.OPEN) return;
+    if (!state.buffer.length) return;
+
+    const ops = state.buffer;
+    state.inflight = ops;
+    state.buffer = [];
+    websocketService.send({
+      type: "DELTA",
+      document_id: documentId,
+      base_version: state.version,
+      ops,
+    });
+  }, []);
 
   useEffect(() => {
     const fetchDocuments = async () => {
@@ -67,7 +122,7 @@ export const DocumentProvider = ({ children }: DocumentProviderProps) => {
           title: doc.title,
           saved: true,
           id: doc.id.toString(),
-          last_update: doc.updated_at || "Just now",
+          last_update: doc.last_updated || "Just now",
           collaborators: doc.collaborators || [{ id: "1", name: "You" }],
           version: doc.version || 0,
           images: doc.images || [],
@@ -163,6 +218,14 @@ export const DocumentProvider = ({ children }: DocumentProviderProps) => {
 
     websocketService.connectOwner(currentDocument.id);
     setWsConnected(true);
+    sync.current = {
+      version: currentDocument.version,
+      content: currentDocument.content,
+      inflight: null,
+      acked: null,
+      buffer: [],
+      local: currentDocument.content,
+    };
     const updateDocuments = (updateContent: any, updatedVersion: any) => {
       setDocuments((prevDocs) =>
         prevDocs.map((doc) =>
@@ -178,30 +241,127 @@ export const DocumentProvider = ({ children }: DocumentProviderProps) => {
           : null
       );
     };
+    // The whole document from the server replaces ours, edits not acknowledged included
+    const resync = (content: any, version: number) => {
+      sync.current = {
+        version,
+        content,
+        inflight: null,
+        acked: null,
+        buffer: [],
+        local: content,
+      };
+      updateDocuments(content, version);
+    };
+    // Our delta in flight was committed at `version`
+    const acknowledge = (version: number) => {
+      const state = sync.current;
+      if (state.inflight?.length) {
+        state.content = applyDelta(state.content, state.inflight);
+      }
+      state.inflight = null;
+      state.acked = null;
+      state.version = Math.max(state.version, version);
+      websocketService.acknowledge(state.version);
+      updateDocuments(state.local, state.version);
+      sendPending(currentDocument.id);
+    };
+    // Ops committed by the server on top of the version we have. The server
+    // rebases our delta in flight over them, so we do the same, and rebase
+    // them over our edits before showing them.
+    const applyCommitted = (ops: DeltaOp[], version: number) => {
+      const state = sync.current;
+      let committed = ops;
+      if (state.inflight) {
+        [state.inflight, committed] = transformOps(state.inflight, committed);
+      }
+      [state.buffer] = transformOps(state.buffer, committed);
+
+      state.content = applyDelta(state.content, ops);
+      state.local = applyDelta(
+        applyDelta(state.content, state.inflight || []),
+        state.buffer
+      );
+      state.version = version;
+      if (caughtUp(state)) {
+        acknowledge(state.acked!);
+      } else {
+        updateDocuments(state.local, version);
+      }
+    };
     const cleanup = websocketService.addMessageHandler((data) => {
+      if (data.type === "CONFLICT") {
+        // The server dropped changes made against an outdated version
+        console.warn("Document conflict, resyncing to version", data.version);
+        resync(data.document.content, data.version);
+      }
+      if (data.type === "INITIALIZE") {
+        // Sent on connect, and when catching up needs the whole document
+        resync(data.document.content, data.document.version);
+      }
       if (data.type === "UPDATE") {
-        console.log("hello", data.document.content);
-        const updatedContent = data.document.content;
-        const updatedVersion = data.document.version || currentDocument.version;
-        updateDocuments(updatedContent, updatedVersion);
+        const updatedVersion = data.document.version || sync.current.version;
+        resync(data.document.content, updatedVersion);
       }
-      if (data.type == "UNDO") {
-        console.log("Undo request received");
-        const updatedContent = data.document.content;
-        const updatedVersion = data.document.version || currentDocument.version;
-        updateDocuments(updatedContent, updatedVersion);
+      if (data.type === "DELTA") {
+        // websocketService only passes on deltas made from the version we have
+        const { ops, version } = data.document;
+        applyCommitted(ops, version);
       }
-      if (data.type == "REDO") {
-        console.log("Redo request received");
-        const updatedContent = data.document.content;
-        const updatedVersion = data.document.version || currentDocument.version;
-
-        updateDocuments(updatedContent, updatedVersion);
+      if (data.type === "ACK" && sync.current.inflight) {
+        // Our own change was committed; other clients receive it instead of us.
+        // The changes committed before it may still be on their way to us.
+        sync.current.acked = data.version;
+        if (caughtUp(sync.current)) {
+          acknowledge(data.version);
+        }
+      }
+      if (data.error && sync.current.inflight) {
+        // Our delta was rejected, resync the server with the whole text instead
+        const state = sync.current;
+        state.inflight = [...state.inflight, ...state.buffer];
+        state.buffer = [];
+        websocketService.send({
+          type: "UPDATE",
+          document_id: currentDocument.id,
+          content: state.local,
+          version: state.version,
+        });
+      }
+      if (
+        data.type === "THROTTLE" &&
+        data.rejected === "DELTA" &&
+        sync.current.inflight
+      ) {
+        // Our delta was dropped over the rate limits: send it again, with the
+        // edits made since, once the server accepts operations
+        const state = sync.current;
+        state.buffer = [...state.inflight, ...state.buffer];
+        state.inflight = null;
+        state.acked = null;
+        if (retryTimer.current) clearTimeout(retryTimer.current);
+        retryTimer.current = setTimeout(() => {
+          retryTimer.current = null;
+          sendPending(currentDocument.id);
+        }, data.retry_after * 1000);
+      }
+      if ((data.type == "UNDO" || data.type == "REDO") && data.success) {
+        console.log(`${data.type} request received`);
+        if (data.document.ops) {
+          // Our own edit undone or redone, sent as a delta like the other clients receive it
+          const { ops, version } = data.document;
+          applyCommitted(ops, version);
+        } else {
+          const updatedVersion = data.document.version || sync.current.version;
+          resync(data.document.content, updatedVersion);
+        }
       }
     });
 
     return () => {
       cleanup();
+      if (retryTimer.current) clearTimeout(retryTimer.current);
+      retryTimer.current = null;
       websocketService.disconnect();
       setWsConnected(false);
     };
@@ -225,35 +385,31 @@ export const DocumentProvider = ({ children }: DocumentProviderProps) => {
 
   const updateContent = useCallback(
     (content: any) => {
-      console.log(currentDocument);
       if (!currentDocument) return;
-      console.log("Updating content:", currentDocument.version);
-      const newVersion = currentDocument.version + 1;
+      // Only the changed text is sent, as a delta against the server's version
+      const state = sync.current;
+      const ops = diffContent(state.local, content);
+      state.buffer.push(...ops);
+      state.local = applyDelta(state.local, ops);
 
       const updatedDocuments = documents.map((doc) =>
         doc.id === currentDocument.id
-          ? { ...doc, content, saved: false, version: newVersion }
+          ? { ...doc, content: state.local, saved: false }
           : doc
       );
 
       setDocuments(updatedDocuments);
       setCurrentDocument({
         ...currentDocument,
-        content,
+        content: state.local,
         saved: false,
-        version: newVersion,
       });
 
       if (wsConnected) {
-        websocketService.send({
-          type: "UPDATE",
-          document_id: currentDocument.id,
-          content: content,
-          version: newVersion, // Send the new version
-        });
+        sendPending(currentDocument.id);
       }
     },
-    [currentDocument, documents, wsConnected]
+    [currentDocument, documents, wsConnected, sendPending]
   );
 
   const handleUndo = useCallback(() => {
@@ -263,7 +419,6 @@ export const DocumentProvider = ({ children }: DocumentProviderProps) => {
     websocketService.send({
       type: "UNDO",
       document_id: currentDocument.id,
-      content: currentDocument.content,
       version: currentDocument.version, // Explicitly send the previous version number
     });
 
@@ -276,7 +431,6 @@ export const DocumentProvider = ({ children }: DocumentProviderProps) => {
     websocketService.send({
       type: "REDO",
       document_id: currentDocument.id,
-      content: currentDocument.content,
       version: currentDocument.version, // Explicitly send the previous version number
     });
 
@@ -1,10 +1,21 @@
 import { apis } from "./init";
 export type PermissionType = "read" | "write" | ["read", "write"];
 
+// Document summaries (no content), most recently updated first, following
+// the cursor of every page
 export const getDocuments = async () => {
-  const { data } = await apis.get("/documents");
-  console.log("Documents", data);
-  return data;
+  const documents: any[] = [];
+  let cursor: string | null = null;
+  do {
+    const { data } = await apis.get("/documents", {
+      params: cursor ? { cursor } : undefined,
+    });
+    documents.push(...data.results);
+    // Only the cursor of `next` is used, its host may differ behind a proxy
+    cursor = data.next ? new URL(data.next).searchParams.get("cursor") : null;
+  } while (cursor);
+  console.log("Documents", documents);
+  return documents;
 };
 
 export const getDocumentAccessToken = async (
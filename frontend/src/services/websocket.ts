@@ -1,5 +1,9 @@
+import { decodeMsgpack, MSGPACK_SUBPROTOCOL } from "../utils/msgpackUtils";
+
 interface WebSocketConfig {
   baseUrl: string;
+  // Receive documents as MessagePack binary frames instead of JSON text
+  binaryFrames: boolean;
   maxReconnectAttempts: number;
   initialConnectionDelay: number;
   reconnectionDelayFactor: number;
@@ -15,11 +19,14 @@ class WebSocketService {
   private isConnecting = false;
   private connectTimeoutId: number | null = null;
   private currentResourceId: string | null = null; // To track what we are connected to
+  private isGuest = false;
+  private lastVersion: number | null = null; // Last document version received, sent back on reconnect
   private readonly config: Required<WebSocketConfig>;
 
   constructor(config?: Partial<WebSocketConfig>) {
     this.config = {
       baseUrl: "ws://text-editor-production-6731.up.railway.app/",
+      binaryFrames: false,
       maxReconnectAttempts: 5,
       initialConnectionDelay: 500,
       reconnectionDelayFactor: 2,
@@ -29,7 +36,11 @@ class WebSocketService {
   }
 
   public connectOwner(documentId: string): void {
+    if (this.currentResourceId !== documentId) {
+      this.lastVersion = null;
+    }
     this.currentResourceId = documentId;
+    this.isGuest = false;
     this.attemptConnectionWithDelay(
       this.buildOwnerWebSocketUrl(documentId),
       this.config.initialConnectionDelay
@@ -37,7 +48,11 @@ class WebSocketService {
   }
 
   public connectGuest(sharedId: string): void {
+    if (this.currentResourceId !== sharedId) {
+      this.lastVersion = null;
+    }
     this.currentResourceId = `${sharedId}`;
+    this.isGuest = true;
     this.attemptConnectionWithDelay(
       this.buildGuestWebSocketUrl(sharedId),
       this.config.initialConnectionDelay
@@ -64,6 +79,7 @@ class WebSocketService {
     this.closeSocket(1000);
     this.resetConnectionState();
     this.currentResourceId = null;
+    this.lastVersion = null;
   }
 
   public get status(): number | undefined {
@@ -90,7 +106,10 @@ class WebSocketService {
     try {
       console.log("Connecting to WebSocket:", url.toString());
 
-      this.socket = new WebSocket(url.toString());
+      this.socket = this.config.binaryFrames
+        ? new WebSocket(url.toString(), [MSGPACK_SUBPROTOCOL])
+        : new WebSocket(url.toString());
+      this.socket.binaryType = "arraybuffer";
       this.setupSocketEventHandlers();
     } catch (error) {
       console.error("Failed to create WebSocket:", error);
@@ -101,15 +120,29 @@ class WebSocketService {
     }
   }
 
-  private buildOwnerWebSocketUrl(documentId: string): URL {
+  private buildOwnerWebSocketUrl(
+    documentId: string,
+    version: number | null = null
+  ): URL {
     const url = new URL(`/ws/document/${documentId}/`, this.config.baseUrl);
     const token = this.getAuthToken();
     url.searchParams.set("token", token);
+    if (version !== null) {
+      // The server then only sends the operations we missed
+      url.searchParams.set("version", version.toString());
+    }
     return url;
   }
 
-  private buildGuestWebSocketUrl(sharedId: string): URL {
-    return new URL(`/ws/document/shared/${sharedId}/`, this.config.baseUrl);
+  private buildGuestWebSocketUrl(
+    sharedId: string,
+    version: number | null = null
+  ): URL {
+    const url = new URL(`/ws/document/shared/${sharedId}/`, this.config.baseUrl);
+    if (version !== null) {
+      url.searchParams.set("version", version.toString());
+    }
+    return url;
   }
 
   private getAuthToken(): string {
@@ -158,14 +191,75 @@ class WebSocketService {
 
   private handleMessage(event: MessageEvent): void {
     try {
-      const data = JSON.parse(event.data);
+      const data =
+        event.data instanceof ArrayBuffer
+          ? decodeMsgpack(event.data)
+          : JSON.parse(event.data);
       console.log("Received message:", data);
+      // Our undone or redone edits also come as ops to apply to the last version
+      const hasOps = data.type === "DELTA" || Array.isArray(data.document?.ops);
+      if (hasOps && !this.followsLastVersion(data.document)) {
+        return;
+      }
+      this.trackVersion(data);
       this.messageHandlers.forEach((handler) => handler(data));
     } catch (error) {
       console.error("Error parsing message:", error);
     }
   }
 
+  // Deltas only apply on top of the version they were made from: skip the ones
+  // already applied, and catch up from our last version when some were missed
+  private followsLastVersion(document: any): boolean {
+    const baseVersion = document?.base_version;
+    if (this.lastVersion === null || typeof baseVersion !== "number") {
+      return true;
+    }
+    if (document.version <= this.lastVersion) {
+      return false;
+    }
+    if (baseVersion !== this.lastVersion) {
+      console.warn(
+        `Missed changes after version ${this.lastVersion}, catching up`
+      );
+      this.resync();
+      return false;
+    }
+    return true;
+  }
+
+  // Reconnect with our last version, the server answers with the missed
+  // operations or the whole document
+  private resync(): void {
+    if (!this.currentResourceId || this.isConnecting) {
+      return;
+    }
+    const url = this.isGuest
+      ? this.buildGuestWebSocketUrl(this.currentResourceId, this.lastVersion)
+      : this.buildOwnerWebSocketUrl(this.currentResourceId, this.lastVersion);
+    this.closeSocket();
+    this.attemptConnectionWithDelay(url, 0);
+  }
+
+  private trackVersion(data: any): void {
+    // An ACK can arrive before the changes committed ahead of ours, which must
+    // still be let through: its version is passed to acknowledge once they are
+    if (data.type === "ACK") {
+      return;
+    }
+    const version = data.document?.version ?? data.version;
+    if (typeof version === "number") {
+      this.lastVersion = version;
+    }
+  }
+
+  // Our own change is committed at `version`, and the ones before it received
+  public acknowledge(version: number): void {
+    if (this.lastVersion === null || version > this.lastVersion) {
+      this.lastVersion = version;
+    }
+  }
+
   private reconnect(resourceId: string): void {
     if (this.reconnectAttempts < this.config.maxReconnectAttempts) {
       this.reconnectAttempts++;
@@ -184,9 +278,9 @@ class WebSocketService {
 
       setTimeout(() => {
         if (!this.isConnecting && this.currentResourceId === resourceId) {
-          const url = resourceId.startsWith("guest/")
-            ? this.buildGuestWebSocketUrl(resourceId.substring(6))
-            : this.buildOwnerWebSocketUrl(resourceId);
+          const url = this.isGuest
+            ? this.buildGuestWebSocketUrl(resourceId, this.lastVersion)
+            : this.buildOwnerWebSocketUrl(resourceId, this.lastVersion);
           this.attemptConnectionWithDelay(url, 0);
         }
       }, delay);
@@ -0,0 +1,234 @@
+export type TextOps = (number | string)[];
+
+export type DeltaOp =
+  | { op: "insert"; index: number; block: object }
+  | { op: "replace"; index: number; block: object }
+  | { op: "delete"; index: number }
+  | { op: "text"; index: number; ops: TextOps }
+  | { op: "field_text"; field: string; ops: TextOps };
+
+// Text components count characters like the server does, by code point
+const chars = (text: string) => Array.from(text);
+
+// Apply retain (> 0), delete (< 0) and insert (string) components to a string
+export const applyTextOps = (text: string, ops: TextOps) => {
+  const characters = chars(text);
+  let result = "";
+  let cursor = 0;
+
+  ops.forEach((component) => {
+    if (typeof component === "string") {
+      result += component;
+    } else if (component > 0) {
+      result += characters.slice(cursor, cursor + component).join("");
+      cursor += component;
+    } else {
+      cursor -= component;
+    }
+  });
+
+  return result + characters.slice(cursor).join("");
+};
+
+// Components turning oldText into newText, replacing what lies between their
+// common prefix and suffix. Empty when the strings are equal.
+export const diffText = (oldText: string, newText: string): TextOps => {
+  const before = chars(oldText);
+  const after = chars(newText);
+  const limit = Math.min(before.length, after.length);
+
+  let prefix = 0;
+  while (prefix < limit && before[prefix] === after[prefix]) {
+    prefix++;
+  }
+  let suffix = 0;
+  while (
+    suffix < limit - prefix &&
+    before[before.length - 1 - suffix] === after[after.length - 1 - suffix]
+  ) {
+    suffix++;
+  }
+
+  const deleted = before.length - prefix - suffix;
+  const inserted = after.slice(prefix, after.length - suffix).join("");
+  if (!deleted && !inserted) {
+    return [];
+  }
+
+  const ops: TextOps = [];
+  if (prefix) ops.push(prefix);
+  if (deleted) ops.push(-deleted);
+  if (inserted) ops.push(inserted);
+  return ops;
+};
+
+const isInsert = (component: number | string): component is string =>
+  typeof component === "string";
+
+const length = (component: number | string) =>
+  isInsert(component) ? chars(component).length : Math.abs(component);
+
+// Drop the first n characters covered by a retain or delete component
+const shorten = (component: number, n: number) =>
+  (component > 0 ? component - n : component + n) || null;
+
+// Append a component, merging it with the previous one of the same kind
+const push = (ops: TextOps, component: number | string) => {
+  const last = ops[ops.length - 1];
+  if (isInsert(component) && last !== undefined && isInsert(last)) {
+    ops[ops.length - 1] = last + component;
+  } else if (
+    !isInsert(component) &&
+    typeof last === "number" &&
+    (last > 0) === (component > 0)
+  ) {
+    ops[ops.length - 1] = last + component;
+  } else {
+    ops.push(component);
+  }
+};
+
+// Rebase text components so they apply after `against` on the same string,
+// the same way as transform_text on the server. When both insert at the same
+// place, `first` decides whose text ends up first.
+export const transformText = (
+  ops: TextOps,
+  against: TextOps,
+  first = false
+): TextOps => {
+  const result: TextOps = [];
+  const a = [...ops];
+  const b = [...against];
+  let op1: number | string | null = a.shift() ?? null;
+  let op2: number | string | null = b.shift() ?? null;
+
+  while (op1 !== null || op2 !== null) {
+    if (
+      op1 !== null &&
+      isInsert(op1) &&
+      (first || op2 === null || !isInsert(op2))
+    ) {
+      push(result, op1);
+      op1 = a.shift() ?? null;
+      continue;
+    }
+    if (op2 !== null && isInsert(op2)) {
+      push(result, length(op2));
+      op2 = b.shift() ?? null;
+      continue;
+    }
+
+    // Past the end of a list everything is implicitly retained
+    const left: number = op1 === null ? length(op2!) : (op1 as number);
+    const right: number = op2 === null ? Math.abs(left) : (op2 as number);
+
+    const n = Math.min(Math.abs(left), Math.abs(right));
+    if (left > 0 && right > 0) {
+      push(result, n);
+    } else if (left < 0 && right > 0) {
+      push(result, -n);
+    }
+    // A delete in `against` already removed what op1 covers
+
+    op1 = shorten(left, n);
+    op2 = shorten(right, n);
+    if (op1 === null) op1 = a.shift() ?? null;
+    if (op2 === null) op2 = b.shift() ?? null;
+  }
+
+  // Trailing retains are implicit
+  let last = result[result.length - 1];
+  while (typeof last === "number" && last > 0) {
+    result.pop();
+    last = result[result.length - 1];
+  }
+  return result;
+};
+
+const transformOp = (
+  op: DeltaOp,
+  against: DeltaOp,
+  first: boolean
+): DeltaOp | null => {
+  if (
+    op.op !== "field_text" ||
+    against.op !== "field_text" ||
+    op.field !== against.field
+  ) {
+    return op;
+  }
+  const ops = transformText(op.ops, against.ops, first);
+  return ops.length ? { ...op, ops } : null;
+};
+
+// Rebase our ops over `against`, committed before them from the same version,
+// and `against` over ours: returns [ops, against] both rebased, like
+// transform_ops on the server. Our ops are field edits, which block
+// operations don't affect.
+export const transformOps = (
+  ops: DeltaOp[],
+  against: DeltaOp[]
+): [DeltaOp[], DeltaOp[]] => {
+  let rebased = [...ops];
+  const rebasedAgainst: DeltaOp[] = [];
+
+  against.forEach((other) => {
+    let current: DeltaOp | null = other;
+    const next: DeltaOp[] = [];
+    rebased.forEach((op) => {
+      if (current === null) {
+        next.push(op);
+        return;
+      }
+      const newOp = transformOp(op, current, false);
+      current = transformOp(current, op, true);
+      if (newOp) next.push(newOp);
+    });
+    rebased = next;
+    if (current) rebasedAgainst.push(current);
+  });
+
+  return [rebased, rebasedAgainst];
+};
+
+// The plain text the editor shows, from either form of the content
+export const contentText = (content: any): string =>
+  typeof content === "string" ? content : content?.content || "";
+
+const asContent = (content: any) =>
+  content && typeof content === "object"
+    ? content
+    : { blocks: [], type: "text", content: content || "" };
+
+// Operations turning the text of one content into the text of another
+export const diffContent = (oldContent: any, newContent: any): DeltaOp[] => {
+  const ops = diffText(contentText(oldContent), contentText(newContent));
+  return ops.length ? [{ op: "field_text", field: "content", ops }] : [];
+};
+
+// Apply block and field operations received in a DELTA message to the current content
+export const applyDelta = (content: any, ops: DeltaOp[]) => {
+  const base = asContent(content);
+  const blocks = [...(base.blocks || [])];
+  const result = { ...base, blocks };
+
+  ops.forEach((op) => {
+    if (op.op === "insert") {
+      blocks.splice(op.index, 0, op.block);
+    } else if (op.op === "delete") {
+      blocks.splice(op.index, 1);
+    } else if (op.op === "replace") {
+      blocks[op.index] = op.block;
+    } else if (op.op === "text") {
+      const block: any = blocks[op.index] || {};
+      blocks[op.index] = {
+        ...block,
+        content: applyTextOps(block.content || "", op.ops),
+      };
+    } else if (op.op === "field_text") {
+      result[op.field] = applyTextOps(result[op.field] || "", op.ops);
+    }
+  });
+
+  return result;
+};
@@ -0,0 +1,135 @@
+// Subprotocol offered to the server to receive documents as MessagePack binary frames
+export const MSGPACK_SUBPROTOCOL = "textflow.msgpack";
+
+const textDecoder = new TextDecoder();
+
+// Decode a MessagePack value; only the types the server sends (no extensions) are supported
+export const decodeMsgpack = (buffer: ArrayBuffer): any => {
+  const view = new DataView(buffer);
+  const bytes = new Uint8Array(buffer);
+  let offset = 0;
+
+  const readString = (length: number) => {
+    const value = textDecoder.decode(bytes.subarray(offset, offset + length));
+    offset += length;
+    return value;
+  };
+
+  const readArray = (length: number) => {
+    const value = new Array(length);
+    for (let i = 0; i < length; i++) {
+      value[i] = read();
+    }
+    return value;
+  };
+
+  const readMap = (length: number) => {
+    const value: Record<string, any> = {};
+    for (let i = 0; i < length; i++) {
+      const key = read();
+      value[key] = read();
+    }
+    return value;
+  };
+
+  const readBinary = (length: number) => {
+    const value = bytes.slice(offset, offset + length);
+    offset += length;
+    return value;
+  };
+
+  const read = (): any => {
+    const type = view.getUint8(offset++);
+    if (type <= 0x7f) return type;
+    if (type <= 0x8f) return readMap(type & 0x0f);
+    if (type <= 0x9f) return readArray(type & 0x0f);
+    if (type <= 0xbf) return readString(type & 0x1f);
+    if (type >= 0xe0) return type - 0x100;
+
+    let value: any;
+    switch (type) {
+      case 0xc0:
+        return null;
+      case 0xc2:
+        return false;
+      case 0xc3:
+        return true;
+      case 0xc4:
+        return readBinary(view.getUint8(offset++));
+      case 0xc5:
+        value = view.getUint16(offset);
+        offset += 2;
+        return readBinary(value);
+      case 0xc6:
+        value = view.getUint32(offset);
+        offset += 4;
+        return readBinary(value);
+      case 0xca:
+        value = view.getFloat32(offset);
+        offset += 4;
+        return value;
+      case 0xcb:
+        value = view.getFloat64(offset);
+        offset += 8;
+        return value;
+      case 0xcc:
+        return view.getUint8(offset++);
+      case 0xcd:
+        value = view.getUint16(offset);
+        offset += 2;
+        return value;
+      case 0xce:
+        value = view.getUint32(offset);
+        offset += 4;
+        return value;
+      case 0xcf:
+        value = Number(view.getBigUint64(offset));
+        offset += 8;
+        return value;
+      case 0xd0:
+        return view.getInt8(offset++);
+      case 0xd1:
+        value = view.getInt16(offset);
+        offset += 2;
+        return value;
+      case 0xd2:
+        value = view.getInt32(offset);
+        offset += 4;
+        return value;
+      case 0xd3:
+        value = Number(view.getBigInt64(offset));
+        offset += 8;
+        return value;
+      case 0xd9:
+        return readString(view.getUint8(offset++));
+      case 0xda:
+        value = view.getUint16(offset);
+        offset += 2;
+        return readString(value);
+      case 0xdb:
+        value = view.getUint32(offset);
+        offset += 4;
+        return readString(value);
+      case 0xdc:
+        value = view.getUint16(offset);
+        offset += 2;
+        return readArray(value);
+      case 0xdd:
+        value = view.getUint32(offset);
+        offset += 4;
+        return readArray(value);
+      case 0xde:
+        value = view.getUint16(offset);
+        offset += 2;
+        return readMap(value);
+      case 0xdf:
+        value = view.getUint32(offset);
+        offset += 4;
+        return readMap(value);
+      default:
+        throw new Error(`Unsupported MessagePack type 0x${type.toString(16)}`);
+    }
+  };
+
+  return read();
+};